@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Speed and output equivalence of the downsample.py engines.
+
+Downsamples one tile with the NumPy engine in memory, with the NumPy engine forced
+through its on-disk slab path and, when the PDAL Python bindings are installed, with
+filters.voxelcenternearestneighbor, then checks every output holds the same points.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+import downsample
+import ply_io
+
+
+def xyz(ply):
+    # Downsampled coordinates in a canonical order, PDAL may name the dimensions X, Y, Z
+    arr = ply_io.read_ply(ply, as_array=True)
+    names = {name.lower(): name for name in arr.dtype.names}
+    points = np.column_stack([arr[names[c]] for c in 'xyz'])
+    return points[np.lexsort(points.T[::-1])]
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('ply', type=str, help='tile to downsample')
+    parser.add_argument('-l', '--length', type=float, default=0.02, help='voxel edge length')
+    parser.add_argument('--max-memory', type=float, default=0.25, help='GB budget used to force the slab path')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per engine, the fastest is reported')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs = {name: os.path.join(tmp, f'{name}.downsample.ply') for name in ['numpy', 'numpy-slabs', 'pdal']}
+        engines = {
+            'numpy': lambda: downsample.downsample_numpy(args.ply, outputs['numpy'], args.length),
+            'numpy-slabs': lambda: downsample.downsample_numpy(
+                args.ply, outputs['numpy-slabs'], args.length, max_memory=args.max_memory * 2**30
+            ),
+            'pdal': lambda: downsample.downsample_pdal(args.ply, outputs['pdal'], args.length),
+        }
+
+        count = ply_io.read_ply_header(args.ply)[1]
+        print(f'{args.ply}: {count} points, voxel {args.length} m')
+        print(f'{"engine":<14}{"seconds":>10}{"points":>12}  same points as numpy')
+        reference = None
+        for name, engine in engines.items():
+            try:
+                seconds = min(timed(engine) for _ in range(args.repeat))
+            except ImportError as e:
+                print(f'{name:<14}  skipped: {e}')
+                continue
+            points = xyz(outputs[name])
+            if reference is None:
+                reference = points
+            same = len(points) == len(reference) and np.allclose(points, reference, rtol=0, atol=1e-6)
+            print(f'{name:<14}{seconds:>10.2f}{len(points):>12}  {same}')
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+Wall time and size of rxp2ply temporary shards per --tmp-codec.
+
+Writes the same records as raw and compressed shards with tiling.ShardWriter into
+--dir, drops them from the page cache, then appends them into a tile file as the
+xyz -> ply conversion does. Point --dir at the storage to be measured (e.g. the
+scratch filesystem), records come from an existing tile with --ply or are synthetic.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import ply_io
+import tiling
+
+
+def synthetic_records(n, seed=0):
+    # Points on a rough surface with mm noise, refl/dev/returns in realistic ranges
+    rng = np.random.default_rng(seed)
+    records = np.empty(n, dtype=tiling.RECORD_DTYPE)
+    records['x'] = rng.uniform(0, 10, n)
+    records['y'] = rng.uniform(0, 10, n)
+    records['z'] = np.sin(records['x']) + np.cos(records['y']) + rng.normal(0, 0.001, n) + 350
+    records['refl'] = rng.normal(-8, 3, n).round(2)
+    records['dev'] = rng.integers(0, 15, n)
+    records['ReturnNumber'] = rng.integers(1, 4, n)
+    records['NumberOfReturns'] = np.maximum(records['ReturnNumber'], rng.integers(1, 4, n))
+    records['sp'] = 1
+    return records
+
+
+def drop_cache(paths):
+    # Flush and evict files so the read back comes from the storage, not memory
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def run(codec, records, directory, n_tiles, flush_bytes):
+    odir = tempfile.mkdtemp(prefix=f'shards-{codec}-', dir=directory)
+    try:
+        tiles = np.array_split(records, n_tiles)
+
+        start = time.perf_counter()
+        with tiling.ShardWriter(odir, '', 1, 3, flush_bytes, codec) as writer:
+            for tile_number, tile in enumerate(tiles):
+                for chunk in np.array_split(tile, 8):
+                    writer.write(tile_number, chunk)
+        shards = [writer.path(t) for t in range(n_tiles)]
+        drop_cache(shards)
+        written = time.perf_counter() - start
+        size = sum(os.path.getsize(fn) for fn in shards)
+
+        start = time.perf_counter()
+        with open(os.path.join(odir, 'tile.xyz'), 'wb') as fh:
+            for fn in shards:
+                tiling.append_shard(fh, fn, tiling.shard_nbytes(fn, records.itemsize), records.dtype)
+        read = time.perf_counter() - start
+    finally:
+        shutil.rmtree(odir)
+
+    return {'codec': codec, 'write': written, 'read': read, 'bytes': size}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', type=str, default='.', help='directory on the storage to benchmark')
+    parser.add_argument('--ply', type=str, default='', help='take the records from this rxp2ply tile')
+    parser.add_argument('--points', type=int, default=20_000_000, help='number of synthetic points')
+    parser.add_argument('--tiles', type=int, default=16, help='number of shards to spread the points over')
+    parser.add_argument('--write-buffer', type=int, default=64, help='MB buffered per flush, as in rxp2ply.py')
+    parser.add_argument('--codecs', nargs='*', default=['none', 'zlib', 'zstd', 'lz4'], help='codecs to compare')
+    args = parser.parse_args()
+
+    if args.ply:
+        records = ply_io.read_ply(args.ply, columns=list(tiling.RECORD_DTYPE.names), as_array=True)
+        records = records.astype(tiling.RECORD_DTYPE)
+    else:
+        records = synthetic_records(args.points)
+
+    print(f'{len(records)} points, {records.nbytes / 2**20:.0f} MB raw')
+    print(f'{"codec":<8}{"write s":>10}{"read s":>10}{"total s":>10}{"MB":>10}{"ratio":>8}')
+    for codec in args.codecs:
+        try:
+            r = run(codec, records, args.dir, args.tiles, args.write_buffer * 2**20)
+        except Exception as e:
+            print(f'{codec:<8}  skipped: {e}')
+            continue
+        print(
+            f'{codec:<8}{r["write"]:>10.2f}{r["read"]:>10.2f}{r["write"] + r["read"]:>10.2f}'
+            f'{r["bytes"] / 2**20:>10.0f}{records.nbytes / r["bytes"]:>8.2f}'
+        )
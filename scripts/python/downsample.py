@@ -5,32 +5,160 @@ import glob
 import multiprocessing
 import argparse
 import json
-import pdal
+import tempfile
+
+import numpy as np
+
+import ply_io
 
 start = datetime.now()
 
-def downsample(ply, args):
-    
-    start_time = datetime.now()
-    if args.verbose:
-        with args.Lock:
-            msg = f'[{datetime.now().strftime("%H:%M:%S")}] Worker started to downsample: {ply}'
-            print(msg)
-            write_to_log(msg, args.log_file)
+def voxel_nearest(x, y, z, length, origin):
+
+    """
+    Index of the point nearest the centre of every occupied voxel, voxels of 
+    edge length counted from origin (the bounds minimum, as PDAL's 
+    filters.voxelcenternearestneighbor does). Ties keep the first point. 
+    Returned in ascending (file) order.
+    """
+
+    if len(x) == 0:
+        return np.empty(0, dtype=np.int64)
+    ijk = [np.floor((np.asarray(v, dtype='f8') - o) / length).astype(np.int64) for v, o in zip([x, y, z], origin)]
+    d2 = np.zeros(len(x))
+    for v, o, i in zip([x, y, z], origin, ijk):
+        d2 += (v - (o + (i + .5) * length))**2
+    key = np.ravel_multi_index(ijk, [i.max() + 1 for i in ijk])
+    # sort by voxel then distance, lexsort is stable so ties stay in file order
+    order = np.lexsort((d2, key))
+    key = key[order]
+    first = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+    return np.sort(order[first])
+
+def voxel_pyramid(x, y, z, lengths, origin):
+
+    """
+    voxel_nearest for each of lengths (ascending), every level chosen from 
+    the points kept by the one before it rather than from all points. 
+    Returns a list of indices into x, y, z.
+    """
+
+    x, y, z = np.asarray(x), np.asarray(y), np.asarray(z)
+    keep, levels = np.arange(len(x)), []
+    for length in lengths:
+        keep = keep[voxel_nearest(x[keep], y[keep], z[keep], length, origin)]
+        levels.append(keep)
+    return levels
+
+def level_path(output, length, directory):
+
+    """000.downsample.ply -> directory/000.downsample.0.05m.ply"""
+
+    name = os.path.basename(output).replace('.downsample.ply', f'.downsample.{length:g}m.ply')
+    return os.path.join(directory, name)
+
+def downsample_numpy(ply, output, length, max_memory=4 * 2**30, tmp_dir=None, levels=(), origin=None):
+
+    """
+    Voxel centre nearest neighbour downsample of ply to output in the same 
+    PLY layout (columns, types and quantisation). Tiles that would need more 
+    than max_memory bytes are partitioned into slabs of voxel columns along 
+    x on disk first and each slab is downsampled in turn. levels is a list 
+    of coarser (length, output) pairs, each derived from the level before 
+    (see voxel_pyramid), voxels are counted from origin (default the bounds 
+    minimum of ply). Returns the number of points written to output.
+    """
+
+    arr, names, quant = ply_io.vertices(ply)
+    stats = ply_io.ply_stats(ply)
+    if stats['count'] == 0:
+        for fn in [output] + [fn for _, fn in levels]:
+            with ply_io.PlyWriter(fn, arr.dtype.newbyteorder('<'), quant=quant):
+                pass
+        return 0
+    if origin is None:
+        origin = stats['bbox'][:3]
+
+    def xyz(records):
+        return [ply_io.decode(records[c], *quant[c]) if c in quant else records[c] for c in 'xyz']
+
+    # record, decoded coordinates, voxel keys, distances and sort order
+    need = len(arr) * (arr.dtype.itemsize + 24 + 40)
+    slabs = int(np.ceil(need / max_memory))
+
+    dtype = np.dtype([(c, arr.dtype[c].newbyteorder('<')) for c in names])
+    if slabs <= 1:
+        records = ply_io.select(arr, names)
+        lengths = [length] + [lvl for lvl, _ in levels]
+        outputs = [output] + [fn for _, fn in levels]
+        pyramid = voxel_pyramid(*xyz(records), lengths, origin)
+        for fn, keep in zip(outputs, pyramid):
+            with ply_io.PlyWriter(fn, dtype, quant=quant) as writer:
+                writer.write(records[keep])
+        return len(pyramid[0])
+
+    with ply_io.PlyWriter(output, dtype, quant=quant) as writer:
+        # external partition by voxel key, slab boundaries on whole voxels so no voxel is split
+        nx = int(np.floor((stats['bbox'][3] - origin[0]) / length)) + 1
+        width = int(np.ceil(nx / slabs))
+        with tempfile.TemporaryDirectory(dir=tmp_dir or os.path.dirname(output) or '.') as tmp:
+            parts = [open(os.path.join(tmp, f'{s}.slab'), 'wb') for s in range(slabs)]
+            for start in range(0, len(arr), 2**22):
+                chunk = ply_io.select(arr[start:start + 2**22], names)
+                slab = np.floor((xyz(chunk)[0] - origin[0]) / length).astype(np.int64) // width
+                order = np.argsort(slab, kind='stable')
+                bounds = np.searchsorted(slab[order], np.arange(slabs + 1))
+                for s in range(slabs):
+                    chunk[order[bounds[s]:bounds[s + 1]]].astype(dtype, copy=False).tofile(parts[s])
+            for part in parts:
+                part.close()
+            for s in range(slabs):
+                records = np.fromfile(os.path.join(tmp, f'{s}.slab'), dtype=dtype)
+                os.unlink(os.path.join(tmp, f'{s}.slab'))
+                writer.write(records[voxel_nearest(*xyz(records), length, origin)])
+    if levels:
+        # the finest level is small enough to be read back whole for the coarser ones
+        downsample_numpy(output, levels[0][1], levels[0][0], max_memory, tmp_dir, levels[1:], origin)
+    return writer.count
+
+def downsample_pdal(ply, output, length):
+
+    import pdal
 
     reader = {"type":"readers.ply",
               "filename":ply}
     
     downsample = {"type":"filters.voxelcenternearestneighbor",
-                  "cell":f"{args.length}"}
+                  "cell":f"{length}"}
     
     writer = {'type':'writers.ply',
               'storage_mode':'little endian',
-              'filename':os.path.join(args.odir, os.path.split(ply)[1].replace('.ply', '.downsample.ply'))}
+              'filename':output}
             
     cmd = json.dumps([reader, downsample, writer])
     pipeline = pdal.Pipeline(cmd)
     pipeline.execute()
+    ply_io.write_stats(output, ply_io.compute_stats(output))
+
+def downsample(ply, args):
+    
+    start_time = datetime.now()
+    if args.verbose:
+        with args.Lock:
+            msg = f'[{datetime.now().strftime("%H:%M:%S")}] Worker started to downsample: {ply}'
+            print(msg)
+            write_to_log(msg, args.log_file)
+
+    output = os.path.join(args.odir, os.path.split(ply)[1].replace('.ply', '.downsample.ply'))
+    levels = [(length, level_path(output, length, args.pyramid_dir)) for length in args.length[1:]]
+    if args.engine == 'pdal':
+        # each coarser level from the file of the level before
+        previous = ply
+        for length, fn in [(args.length[0], output), *levels]:
+            downsample_pdal(previous, fn, length)
+            previous = fn
+    else:
+        downsample_numpy(ply, output, args.length[0], args.max_memory * 2**30, levels=levels)
     
     end_time = datetime.now()
     execution_time = calculate_execution_time(start_time, end_time)
@@ -64,12 +192,26 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-i','--idir', type=str, help='directory where downsampled tiles are stored')
     parser.add_argument('-o','--odir', default='.', help='directory where downsampled tiles are stored')
-    parser.add_argument('-l', '--length', type=float, default=.02, help='voxel edge length')
+    parser.add_argument('-l', '--length', type=float, nargs='+', default=[.02],
+                        help='voxel edge length, several give a pyramid of levels')
+    parser.add_argument('--pyramid-dir', type=str, default='',
+                        help='directory of the coarser --length levels, default ODIR/pyramid')
     parser.add_argument('--num-prcs', type=int, default=10, help='number of cores to use')
+    parser.add_argument('--engine', choices=['numpy', 'pdal'], default='numpy',
+                        help='downsample in process or with PDAL')
+    parser.add_argument('--max-memory', type=float, default=4,
+                        help='GB per worker before --engine numpy works in slabs on disk')
     parser.add_argument('--log-file', type=str, default='', help='log file')
     parser.add_argument('--verbose', action='store_true', help='print something')
     args = parser.parse_args()
     
+    # the finest level goes in odir as before, coarser levels side by side in pyramid_dir
+    args.length = sorted(set(args.length))
+    if not args.pyramid_dir:
+        args.pyramid_dir = os.path.join(args.odir, 'pyramid')
+    if len(args.length) > 1:
+        os.makedirs(args.pyramid_dir, exist_ok=True)
+
     m = multiprocessing.Manager()
     args.Lock = m.Lock()
     pool = multiprocessing.Pool(args.num_prcs)
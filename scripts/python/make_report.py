@@ -2,7 +2,6 @@
 """Generates status reports in markdown, notebooks and uploads to Google sheets"""
 
 import argparse
-import json
 import os
 import time
 import csv
@@ -205,8 +204,10 @@ def format_log_worksheet(worksheet):
 
 
 def get_projects(status_file):
-    with open(status_file) as f:
-        status = json.load(f)
+    # update_status reads LOG_ROOT on import, so only import it once init() has run
+    from update_status import load_status
+
+    status = load_status(status_file)
 
     projects = list(status.keys())
     projects.sort()
@@ -261,9 +262,10 @@ def perform_operation_with_retry(action):
 
 
 def create_markdown_report(status_file):
-    # Open the status.json file and load the data
-    with open(status_file) as f:
-        status = json.load(f)
+    from update_status import load_status
+
+    # Load the status.json snapshot with the journal of later updates
+    status = load_status(status_file)
 
     print(status)
 
@@ -302,9 +304,10 @@ def create_log_markdown(log_file):
 
 
 def create_notebook_report(status_file):
-    # Open the status.json file and load the data
-    with open(status_file) as f:
-        status = json.load(f)
+    from update_status import load_status
+
+    # Load the status.json snapshot with the journal of later updates
+    status = load_status(status_file)
 
     # Create a new notebook
     nb = nbf.v4.new_notebook()
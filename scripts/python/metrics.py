@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Per-stage timing records for rxp2ply workers and a summary of them"""
+
+import argparse
+import json
+import time
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+    Accumulates wall time per named stage, use as `with timer('read'): ...`
+    or add time measured elsewhere with timer.add('write', seconds).
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+def append_record(record, metrics_file):
+    # One JSON object per line, only ever written by the parent process
+    if metrics_file and record:
+        with open(metrics_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def read_records(metrics_file):
+    with open(metrics_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def summarise(records, top=10):
+    scans = [r for r in records if r.get('type') == 'scan']
+    tiles = [r for r in records if r.get('type') == 'tile']
+
+    lines = [f'{len(scans)} scans, {len(tiles)} tiles']
+
+    # total time per stage across all scans, largest first
+    stages = {}
+    for r in scans:
+        for stage, seconds in r.get('stages', {}).items():
+            stages[stage] = stages.get(stage, 0.0) + seconds
+    total = sum(stages.values()) or 1
+    lines.append('')
+    lines.append(f'{"stage":<16}{"seconds":>12}{"share":>8}')
+    for stage, seconds in sorted(stages.items(), key=lambda kv: -kv[1]):
+        lines.append(f'{stage:<16}{seconds:>12.1f}{seconds / total:>8.1%}')
+
+    lines.append('')
+    lines.append(f'slowest {min(top, len(scans))} scans')
+    lines.append(f'{"scan":<24}{"runtime":>10}{"points":>14}{"MB":>10}{"rss MB":>10}  slowest stage')
+    for r in sorted(scans, key=lambda r: -r.get('runtime', 0))[:top]:
+        slowest = max(r.get('stages', {'-': 0}).items(), key=lambda kv: kv[1])
+        lines.append(
+            f'{r["scan"]:<24}{r.get("runtime", 0):>10.1f}{r.get("points", 0):>14}'
+            f'{r.get("bytes", 0) / 2**20:>10.1f}{r.get("peak_rss_mb", 0):>10.0f}  {slowest[0]} {slowest[1]:.1f}s'
+        )
+
+    if tiles:
+        lines.append('')
+        lines.append(f'slowest {min(top, len(tiles))} tiles')
+        lines.append(f'{"tile":<24}{"runtime":>10}{"points":>14}{"MB":>10}')
+        for r in sorted(tiles, key=lambda r: -r.get('runtime', 0))[:top]:
+            lines.append(
+                f'{r["tile"]:<24}{r.get("runtime", 0):>10.1f}{r.get("points", 0):>14}{r.get("bytes", 0) / 2**20:>10.1f}'
+            )
+
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('metrics_file', type=str, help='.metrics.jsonl file written by rxp2ply.py')
+    parser.add_argument('--top', type=int, default=10, help='number of slowest scans and tiles to list')
+    args = parser.parse_args()
+
+    print(summarise(read_records(args.metrics_file), args.top))
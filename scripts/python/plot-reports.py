@@ -22,19 +22,25 @@ def process_tree(row, params):
     t = os.path.split(row.cloud)[1].split('.')[0]#[:-11] 
     
     # point cloud
-    pc = ply_io.read_ply(row.cloud)
-    pc.loc[:, 'nz'] = pc.z - pc.z.min()
-    pc_height = np.ptp(pc.z)
+    # z range from the statistics sidecar when the cloud has one
+    stats = ply_io.ply_stats(row.cloud, compute=False)
+    pc = ply_io.read_ply(row.cloud, columns=['x', 'y'] if stats else ['x', 'y', 'z'])
+    z_min = stats['columns']['z']['min'] if stats else pc.z.min()
+    pc_height = stats['columns']['z']['max'] - z_min if stats else np.ptp(pc.z)
    
     hull = ConvexHull(pc.sample(min(int(1e5), len(pc)))[['x', 'y']])
     
-    if 'wood' in pc.columns:
-        pc = pc.loc[pc.wood == 1]
-    elif 'label' in pc.columns:
-        pc = pc.loc[pc.label == 3]
+    # only the wood points in the 1.3 - 1.4 m slice are needed for the stem position
+    fields = ply_io.read_ply_header(row.cloud)[2].names
+    where = {'z':(z_min + 1.3, z_min + 1.4)}
+    if 'wood' in fields:
+        where['wood'] = 1
+    elif 'label' in fields:
+        where['label'] = 3
     else: pass
-    X = pc.x.loc[pc.nz.between(1.3, 1.4)].mean()
-    Y = pc.y.loc[pc.nz.between(1.3, 1.4)].mean()
+    stem = ply_io.read_ply(row.cloud, columns=['x', 'y'], where=where)
+    X = stem.x.mean()
+    Y = stem.y.mean()
     
     M = {'tree':t, 'x_m':X, 'y_m':Y, 'pc_height':pc_height, 'hull_volume':hull.volume}
     M['geometry_crown'] = Polygon(hull.points[hull.vertices])
@@ -1,91 +1,594 @@
-import pandas as pd
+import os
 import numpy as np
-import sys
 
-def open_ply(fp, newline=None):
+# pandas is imported where DataFrames are built so that header and raw record
+# helpers stay cheap to import in worker processes
 
-    if (sys.version_info > (3, 0)):
-        return open(fp, encoding='ISO-8859-1', newline=newline)
+# PLY property type -> numpy dtype
+dtype_map = {'uint16':'uint16', 'uint8':'uint8', 'double':'d', 'float64':'f8', 
+             'float32':'f4', 'float': 'f4', 'uchar': 'B', 'int':'i', 'int32':'i4',
+             'uint':'u4', 'uint32':'u4', 'short':'i2', 'int16':'i2', 'ushort':'u2',
+             'char':'i1', 'int8':'i1'}
+
+def read_ply(fp, columns=None, as_array=False, step=1, where=None):
+
+    """
+    Read the vertices of a PLY file. Only the header is parsed as text, a 
+    binary vertex block is memory mapped so only the requested columns are 
+    read from disk. columns selects (and orders) the properties returned, 
+    as_array returns a numpy structured array instead of a DataFrame. step 
+    and where are applied chunk by chunk as in iter_ply. Quantised columns 
+    (see PlyWriter) are decoded to float64.
+    """
+
+    arr, names, quant = vertices(fp, columns)
+    if step == 1 and not where:
+        out = select(arr, names, quant=quant)
+    else:
+        chunks = list(iter_chunks(fp, arr, names, step=step, where=where, quant=quant))
+        out = np.concatenate(chunks) if chunks else select(arr[:0], names, quant=quant)
+
+    if as_array:
+        return out
+
+    import pandas as pd
+    return pd.DataFrame({c: out[c] for c in out.dtype.names})
+
+def read_many(paths, columns=None, workers=8, concat=False, as_array=False, step=1, where=None):
+
+    """
+    Read many PLY files concurrently with a pool of workers threads (reading 
+    is mostly I/O and array copies, which release the GIL). columns, step 
+    and where are applied to every file as in read_ply. Returns a list with 
+    one DataFrame (or structured array with as_array) per path, or with 
+    concat a single DataFrame / array of all files plus an offsets array so 
+    that the rows of paths[i] are offsets[i]:offsets[i + 1]. Columns stored 
+    with different types in different files are promoted to a common type.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    def read(fp):
+        return read_ply(fp, columns=columns, as_array=True, step=step, where=where)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        arrays = list(pool.map(read, paths))
+
+    if concat:
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(arr) for arr in arrays], out=offsets[1:])
+        if len(set(arr.dtype.names for arr in arrays)) > 1:
+            raise Exception('files have different columns, pass columns= to read a common subset')
+        if len(set(arr.dtype for arr in arrays)) > 1:
+            # same columns stored with different types, promote each column to a common type
+            dtype = [(c, np.result_type(*[arr.dtype[c] for arr in arrays])) for c in arrays[0].dtype.names]
+            arrays = [arr.astype(dtype) for arr in arrays]
+        arr = np.concatenate(arrays) if arrays else np.empty(0)
+        if as_array:
+            return arr, offsets
+        import pandas as pd
+        return pd.DataFrame({c: arr[c] for c in arr.dtype.names or []}), offsets
+
+    if as_array:
+        return arrays
+    import pandas as pd
+    return [pd.DataFrame({c: arr[c] for c in arr.dtype.names}) for arr in arrays]
+
+def iter_ply(fp, columns=None, chunk_size=1000000, step=1, where=None):
+
+    """
+    Iterate over the vertices of a PLY file in structured arrays of at most 
+    chunk_size records, so large tiles can be processed in bounded memory.
+    step keeps every step-th vertex of the file (as .loc[::step] would) and 
+    where is a dict of column -> value (equality) or (lo, hi) (inclusive 
+    range) predicates applied to each chunk after the stride, e.g. 
+    where={'label': 3, 'z': (0, 2)}. Predicate columns need not be in columns.
+    """
+
+    arr, names, quant = vertices(fp, columns)
+    return iter_chunks(fp, arr, names, chunk_size=chunk_size, step=step, where=where, quant=quant)
+
+def iter_chunks(fp, arr, names, chunk_size=1000000, step=1, where=None, quant=None):
+
+    where = where or {}
+    quant = quant or {}
+    missing = [c for c in where if c not in arr.dtype.names]
+    if missing:
+        raise KeyError(f'{fp} has no column(s) {", ".join(missing)}')
+
+    # keep chunks aligned to the stride so every chunk starts on a kept vertex
+    chunk_size = max(step, chunk_size // step * step)
+
+    for start in range(0, len(arr), chunk_size):
+        chunk = arr[start:start + chunk_size:step]
+        mask = np.ones(len(chunk), dtype=bool)
+        for c, v in where.items():
+            values = decode(chunk[c], *quant[c]) if c in quant else chunk[c]
+            if isinstance(v, (tuple, list)):
+                mask &= (values >= v[0]) & (values <= v[1])
+            else:
+                mask &= values == v
+        chunk = select(chunk, names, None if mask.all() else mask, quant)
+        if len(chunk) > 0:
+            yield chunk
+
+def vertices(fp, columns=None):
+
+    """
+    The vertex records of a PLY file, memory mapped when binary, the list 
+    of column names to return and the quantisation of the file.
+    """
+
+    fmt, N, dtype, offset, quant = read_ply_header(fp)
+    names = list(dtype.names) if columns is None else list(columns)
+    missing = [c for c in names if c not in dtype.names]
+    if missing:
+        raise KeyError(f'{fp} has no column(s) {", ".join(missing)}')
+
+    if fmt == 'binary':
+        if N == 0:
+            arr = np.empty(0, dtype=dtype)
+        else:
+            arr = np.memmap(fp, dtype=dtype, mode='r', offset=offset, shape=(N,))
     else:
-        return open(fp)
+        with open(fp, 'rb') as ply:
+            ply.seek(offset)
+            arr = np.loadtxt(ply, dtype=dtype, max_rows=N, ndmin=1)
+
+    return arr, names, quant
+
+def select(arr, names, mask=None, quant=None):
+
+    # copy columns (and masked rows) out of the memmap into native byte order, decoding quantised columns
+    quant = quant or {}
+    dtype = [(c, 'f8' if c in quant else arr.dtype[c].newbyteorder('=')) for c in names]
+    out = np.empty(len(arr) if mask is None else int(mask.sum()), dtype=dtype)
+    for c in names: 
+        values = arr[c] if mask is None else arr[c][mask]
+        out[c] = decode(values, *quant[c]) if c in quant else values
+    return out
 
-def read_ply(fp):
+def decode(values, scale, offset):
+    return values * scale + offset
 
-    line = open_ply(fp).readline()
-    newline = '\n' if line == 'ply\n' else None
+def encode(values, scale, offset):
 
-    return read_ply_(fp, newline)
+    # nearest integer step, int32 like LAS, raising rather than wrapping on overflow
+    q = np.rint((np.asarray(values, dtype='f8') - offset) / scale)
+    if q.size > 0 and (q.min() < -2**31 or q.max() > 2**31 - 1):
+        raise ValueError(f'values outside the int32 range of scale {scale} and offset {offset}')
+    return q.astype('<i4')
+
+def quantisation_comments(quant):
+    return [f'quantise {c} {float(scale)!r} {float(offset)!r}' for c, (scale, offset) in quant.items()]
     
-def read_ply_(fp, newline):
-
-    with open_ply(fp, newline=newline) as ply:
- 
-        length = 0
-        prop = []
-        dtype_map = {'uint16':'uint16', 'uint8':'uint8', 'double':'d', 'float64':'f8', 
-                     'float32':'f4', 'float': 'f4', 'uchar': 'B', 'int':'i'}
-        dtype = []
-        fmt = 'binary'
-
-        for i, line in enumerate(ply.readlines()):
-            length += len(line)
-            if i == 1:
-                if 'ascii' in line:
-                    fmt = 'ascii' 
-            if 'element vertex' in line: N = int(line.split()[2])
-            if 'property' in line: 
-                dtype.append(dtype_map[line.split()[1]])
-                prop.append(line.split()[2])
-            if 'element face' in line:
+# numpy dtype -> PLY property type, names chosen so read_ply and PDAL both understand them
+ply_types = {'f8':'float64', 'f4':'float32', 'u1':'uint8', 'u2':'uint16', 'u4':'uint',
+             'i1':'char', 'i2':'short', 'i4':'int'}
+
+def read_ply_header(fp):
+
+    """
+    Parse only the header bytes of a PLY file, returns the format, the 
+    number of vertices, the numpy dtype of a vertex record, the byte 
+    offset of the vertex block and column -> (scale, offset) of the 
+    quantised columns, from "comment quantise <column> <scale> <offset>" 
+    header lines.
+    """
+
+    with open(fp, 'rb') as ply:
+
+        fmt, N, prop, quant = 'binary', 0, [], {}
+        byteorder = '<'
+
+        while True:
+            line = ply.readline()
+            if not line:
+                raise Exception(f'{fp} has no end_header')
+            line = line.decode('ISO-8859-1').split()
+            if len(line) == 0:
+                continue
+            if line[0] == 'format':
+                if 'ascii' in line[1]:
+                    fmt = 'ascii'
+                if 'big_endian' in line[1]:
+                    byteorder = '>'
+            if line[:2] == ['element', 'vertex']:
+                N = int(line[2])
+            if line[:2] == ['element', 'face']:
                 raise Exception('.ply appears to be a mesh')
-            if 'end_header' in line: break
-    
-        ply.seek(length)
+            if line[:2] == ['comment', 'quantise']:
+                quant[line[2]] = (float(line[3]), float(line[4]))
+            if line[0] == 'property': 
+                prop.append((line[2], np.dtype(dtype_map[line[1]]).newbyteorder(byteorder)))
+            if line[0] == 'end_header':
+                break
 
-        if fmt == 'binary':
-            arr = np.fromfile(ply, dtype=','.join(dtype))
-        else:
-            arr = np.loadtxt(ply)
-        df = pd.DataFrame(data=arr)
-        df.columns = prop
-
-    return df
-
-def write_ply(output_name, pc, comments=[]):
-
-    cols = ['x', 'y', 'z']
-    pc[['x', 'y', 'z']] = pc[['x', 'y', 'z']].astype('f8')
-
-    with open(output_name, 'w') as ply:
-
-        ply.write("ply\n")
-        ply.write('format binary_little_endian 1.0\n')
-        ply.write("comment Author: Phil Wilkes\n")
-        for comment in comments:
-            ply.write("comment {}\n".format(comment))
-        ply.write("obj_info generated with pcd2ply.py\n")
-        ply.write("element vertex {}\n".format(len(pc)))
-        ply.write("property float64 x\n")
-        ply.write("property float64 y\n")
-        ply.write("property float64 z\n")
-        if 'red' in pc.columns:
-            cols += ['red', 'green', 'blue']
-            pc[['red', 'green', 'blue']] = pc[['red', 'green', 'blue']].astype('i')
-            ply.write("property int red\n")
-            ply.write("property int green\n")
-            ply.write("property int blue\n")
-        for col in pc.columns:
-            if col in cols: continue
+        offset = ply.tell()
+
+    return fmt, N, np.dtype(prop), offset, quant
+
+def write_ply_header(fh, dtype, count, comments=None, pad=False):
+
+    """
+    Write a binary little endian PLY header describing count records of the
+    structured dtype to the binary file handle fh, the records themselves
+    can then be appended as raw bytes. pad reserves a fixed width for the 
+    count so the header can be rewritten in place once the count is known.
+    """
+
+    header = ["ply", 
+              "format binary_little_endian 1.0",
+              "comment Author: Phil Wilkes"]
+    header += [f"comment {comment}" for comment in comments or []]
+    header += [f"element vertex {str(count).ljust(20) if pad else count}"]
+    for name in dtype.names:
+        header += [f"property {ply_types[dtype[name].str[1:]]} {name}"]
+    header += ["end_header"]
+    fh.write(("\n".join(header) + "\n").encode('ascii'))
+
+def ply_schema(pc):
+
+    """
+    Little endian PLY record dtype for a DataFrame or structured array, 
+    x, y and z first as float64 and every other column in its own type. 
+    64 bit integers are narrowed to 32 bits when the values allow (PLY has 
+    no 64 bit integers) and bools stored as uint8, columns that cannot be 
+    stored as numbers are dropped.
+    """
+
+    names = list(pc.dtype.names) if isinstance(pc, np.ndarray) else list(pc.columns)
+    schema = [(c, '<f8') for c in ['x', 'y', 'z'] if c in names]
+
+    for col in names:
+        if col in ['x', 'y', 'z']:
+            continue
+        values = np.asarray(pc[col])
+        dt = values.dtype
+        if dt.kind == 'b':
+            dt = np.dtype('u1')
+        elif dt.kind in 'iu' and dt.itemsize == 8:
+            small = np.dtype('i4' if dt.kind == 'i' else 'u4')
+            info = np.iinfo(small)
+            fits = len(values) == 0 or (values.min() >= info.min and values.max() <= info.max)
+            dt = small if fits else np.dtype('f8')
+        elif dt.kind not in 'iuf' or dt.itemsize > 8:
             try:
-                pc[col] = pc[col].astype('f8')
-                ply.write("property float64 {}\n".format(col))
-                cols += [col]
-            except:
-                pass
-        ply.write("end_header\n")
-
-    with open(output_name, 'ab') as ply:
-        ply.write(pc[cols].to_records(index=False).tobytes()) 
+                values.astype('f8')
+                dt = np.dtype('f8')
+            except (TypeError, ValueError):
+                continue
+        if dt.kind == 'f' and dt.itemsize == 2:
+            dt = np.dtype('f4')
+        schema.append((col, dt.newbyteorder('<')))
+
+    return np.dtype(schema)
+
+class PlyWriter:
+
+    """
+    Streaming binary PLY writer, e.g.
+
+        with PlyWriter('tile.ply', ply_schema(first_chunk)) as w:
+            for chunk in chunks: w.write(chunk)
+
+    Chunks (DataFrames or structured arrays) are appended in the schema's 
+    types, arrays already in the schema are written without a copy and the 
+    caller's data is never modified. The vertex count is patched into the 
+    header on close, along with a statistics sidecar (see ply_stats) 
+    unless stats=False.
+
+    quant maps columns to a (scale, offset) LAS style int32 encoding, e.g. 
+    {'x':(.001, 500.), 'y':(.001, 300.), 'z':(.001, 0.)}, recorded in the 
+    header and decoded again by read_ply. Chunks are encoded on write 
+    unless they are already in the quantised record layout.
+    """
+
+    def __init__(self, output_name, dtype, comments=None, stats=True, quant=None):
+
+        self.output_name = output_name
+        self.quant = dict(quant or {})
+        self.dtype = np.dtype([(c, '<i4' if c in self.quant else dtype[c]) for c in np.dtype(dtype).names])
+        self.comments = list(comments or []) + quantisation_comments(self.quant)
+        self.count = 0
+        self.stats = PlyStats() if stats else None
+        self.fh = open(output_name, 'wb')
+        write_ply_header(self.fh, self.dtype, 0, self.comments, pad=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, chunk):
+
+        if isinstance(chunk, np.ndarray) and chunk.dtype == self.dtype:
+            records = chunk
+        else:
+            records = np.empty(len(chunk), dtype=self.dtype)
+            for name in self.dtype.names:
+                records[name] = encode(chunk[name], *self.quant[name]) if name in self.quant else chunk[name]
+        np.ascontiguousarray(records).tofile(self.fh)
+        self.count += len(records)
+        if self.stats is not None: 
+            self.stats.update(select(records, self.dtype.names, quant=self.quant) if self.quant else records)
+
+    def close(self):
+
+        if self.fh.closed:
+            return
+        self.fh.seek(0)
+        write_ply_header(self.fh, self.dtype, self.count, self.comments, pad=True)
+        self.fh.close()
+        if self.stats is not None:
+            write_stats(self.output_name, self.stats)
+
+class PlyStats:
+
+    """
+    Running point count, bounding box, per column min / max / mean and a 
+    z histogram (z_bin wide bins) accumulated over chunks of points.
+    """
+
+    def __init__(self, z_bin=1.):
+
+        self.z_bin = z_bin
+        self.count = 0
+        self.columns = {}
+        self.z_hist = {}
+
+    def update(self, chunk):
+
+        if len(chunk) == 0:
+            return
+        names = chunk.dtype.names if isinstance(chunk, np.ndarray) else chunk.columns
+        for name in names:
+            values = np.asarray(chunk[name])
+            if values.dtype.kind not in 'iufb':
+                continue
+            lo, hi, total = values.min(), values.max(), values.sum(dtype='f8')
+            if name in self.columns:
+                c = self.columns[name]
+                c['min'], c['max'], c['sum'] = min(c['min'], lo), max(c['max'], hi), c['sum'] + total
+            else:
+                self.columns[name] = {'min':lo, 'max':hi, 'sum':total}
+        if 'z' in names:
+            k = np.floor(np.asarray(chunk['z']) / self.z_bin).astype(np.int64)
+            k0 = k.min()
+            for i, n in enumerate(np.bincount(k - k0)):
+                if n:
+                    self.z_hist[int(k0) + i] = self.z_hist.get(int(k0) + i, 0) + int(n)
+        self.count += len(chunk)
+
+    def merge(self, other):
+
+        """Add the points summarised by other, a PlyStats with the same z_bin"""
+
+        for name, o in other.columns.items():
+            if name in self.columns:
+                c = self.columns[name]
+                c['min'], c['max'], c['sum'] = min(c['min'], o['min']), max(c['max'], o['max']), c['sum'] + o['sum']
+            else:
+                self.columns[name] = dict(o)
+        for k, n in other.z_hist.items():
+            self.z_hist[k] = self.z_hist.get(k, 0) + n
+        self.count += other.count
+
+    @classmethod
+    def from_dict(cls, stats):
+
+        """PlyStats from a to_dict (e.g. a sidecar), sums are recovered from the means"""
+
+        self = cls(stats['z_hist']['bin'] if 'z_hist' in stats else 1.)
+        self.count = stats['count']
+        self.columns = {name:{'min':np.asarray(c['min'])[()], 'max':np.asarray(c['max'])[()], 
+                              'sum':c['mean'] * self.count} 
+                        for name, c in stats['columns'].items()}
+        if 'z_hist' in stats:
+            k0 = round(stats['z_hist']['origin'] / self.z_bin)
+            self.z_hist = {k0 + i:n for i, n in enumerate(stats['z_hist']['counts']) if n}
+        return self
+
+    def to_dict(self):
+
+        columns = {name:{'min':c['min'].item(), 'max':c['max'].item(), 'mean':float(c['sum'] / self.count)} 
+                   for name, c in self.columns.items()}
+        stats = {'count':self.count, 'columns':columns}
+        if all(c in columns for c in 'xyz'):
+            stats['bbox'] = [columns[c]['min'] for c in 'xyz'] + [columns[c]['max'] for c in 'xyz']
+        if self.z_hist:
+            k0, k1 = min(self.z_hist), max(self.z_hist)
+            stats['z_hist'] = {'bin':self.z_bin, 'origin':k0 * self.z_bin,
+                               'counts':[self.z_hist.get(k, 0) for k in range(k0, k1 + 1)]}
+        return stats
+
+def stats_path(fp):
+    return fp + '.stats.json'
+
+def write_stats(fp, stats):
+
+    """
+    Write the statistics sidecar of the PLY file fp, stats is a PlyStats or 
+    the dict from PlyStats.to_dict. The size of fp is recorded so a stale 
+    sidecar can be recognised.
+    """
+
+    import json
+
+    stats = stats.to_dict() if isinstance(stats, PlyStats) else dict(stats)
+    stats['size'] = os.path.getsize(fp)
+    with open(stats_path(fp) + '.tmp', 'w') as fh:
+        json.dump(stats, fh)
+    os.replace(stats_path(fp) + '.tmp', stats_path(fp))
+
+def compute_stats(fp, chunk_size=1000000):
+
+    # one pass over the memory mapped vertices of fp
+    stats = PlyStats()
+    for chunk in iter_ply(fp, chunk_size=chunk_size):
+        stats.update(chunk)
+    return stats.to_dict()
+
+def ply_stats(fp, compute=True):
+
+    """
+    Summary statistics of the PLY file fp: count, bbox [xmin, ymin, zmin, 
+    xmax, ymax, zmax], per column min / max / mean and a 1 m z histogram. 
+    Read from the {fp}.stats.json sidecar when it is up to date, otherwise 
+    computed in one pass (and the sidecar written where possible) unless 
+    compute is False, in which case None is returned.
+    """
+
+    import json
+
+    sidecar = stats_path(fp)
+    if os.path.isfile(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(fp):
+        with open(sidecar) as fh:
+            stats = json.load(fh)
+        if stats.get('size') == os.path.getsize(fp):
+            return stats
+
+    if not compute:
+        return None
+    stats = compute_stats(fp)
+    try:
+        write_stats(fp, stats)
+    except OSError:
+        pass
+    stats['size'] = os.path.getsize(fp)
+    return stats
+
+def morton_order(x, y, z, bits=21):
+
+    """
+    Order that sorts points along a 3D Morton (Z-order) curve, coordinates
+    are quantised to 2**bits steps over their own range so nearby points 
+    end up in the same blocks of the sorted file.
+    """
+
+    code = np.zeros(len(x), dtype=np.uint64)
+    for axis, v in enumerate([x, y, z]):
+        v = np.asarray(v, dtype='f8')
+        if len(v) == 0:
+            break
+        lo, span = v.min(), max(np.ptp(v), 1e-9)
+        q = ((v - lo) / span * (2**bits - 1)).astype(np.uint64)
+        # spread the bits of q two apart
+        q = (q | (q << np.uint64(32))) & np.uint64(0x1f00000000ffff)
+        q = (q | (q << np.uint64(16))) & np.uint64(0x1f0000ff0000ff)
+        q = (q | (q << np.uint64(8))) & np.uint64(0x100f00f00f00f00f)
+        q = (q | (q << np.uint64(4))) & np.uint64(0x10c30c30c30c30c3)
+        q = (q | (q << np.uint64(2))) & np.uint64(0x1249249249249249)
+        code |= q << np.uint64(axis)
+    return np.argsort(code, kind='stable')
+
+# layout of the {ply}.index.npy chunk index, one row per block of points
+index_dtype = np.dtype([('start', 'u8'), ('count', 'u4'), 
+                        ('xmin', 'f8'), ('ymin', 'f8'), ('zmin', 'f8'), 
+                        ('xmax', 'f8'), ('ymax', 'f8'), ('zmax', 'f8')])
+
+def index_path(fp):
+    return fp + '.index.npy'
+
+def write_index(fp, arr, block_size=65536, quant=None):
+
+    """
+    Write the chunk index of the PLY file fp whose vertices are arr (in 
+    file order, quantised columns still encoded with quant): the bounding 
+    box of every block_size consecutive points. Only useful when the file 
+    is spatially ordered, see sort_ply.
+    """
+
+    quant = quant or {}
+    starts = np.arange(0, len(arr), block_size)
+    index = np.empty(len(starts), dtype=index_dtype)
+    index['start'] = starts
+    index['count'] = np.diff(np.append(starts, len(arr)))
+    for c in 'xyz':
+        if len(arr) == 0:
+            break
+        lo, hi = np.minimum.reduceat(arr[c], starts), np.maximum.reduceat(arr[c], starts)
+        index[f'{c}min'] = decode(lo, *quant[c]) if c in quant else lo
+        index[f'{c}max'] = decode(hi, *quant[c]) if c in quant else hi
+    with open(index_path(fp) + '.tmp', 'wb') as fh:
+        np.save(fh, index)
+    os.replace(index_path(fp) + '.tmp', index_path(fp))
+
+def read_index(fp):
+
+    # chunk index of fp, None when there is none or it is older than fp
+    sidecar = index_path(fp)
+    if not os.path.isfile(sidecar) or os.path.getmtime(sidecar) < os.path.getmtime(fp):
+        return None
+    index = np.load(sidecar)
+    if index['count'].sum() != read_ply_header(fp)[1]:
+        return None
+    return index
+
+def sort_ply(fp, output=None, block_size=65536, comments=None):
+
+    """
+    Rewrite the PLY file fp (to output, by default in place) in Morton 
+    order with a chunk index and statistics sidecar, so read_region only 
+    touches the blocks that intersect the region.
+    """
+
+    # sorted in the file's own (possibly quantised) record layout
+    arr, names, quant = vertices(fp)
+    arr = select(arr, names)
+    arr = arr[morton_order(arr['x'], arr['y'], arr['z'])]
+    output = output or fp
+    with PlyWriter(output + '.tmp', arr.dtype.newbyteorder('<'), comments, stats=False, quant=quant) as ply:
+        ply.write(arr.astype(ply.dtype, copy=False))
+    os.replace(output + '.tmp', output)
+    write_index(output, arr, block_size, quant)
+    write_stats(output, compute_stats(output))
+
+def read_region(fp, bbox, columns=None, as_array=False):
+
+    """
+    Read the vertices of fp inside bbox, either [xmin, ymin, xmax, ymax] or 
+    [xmin, ymin, zmin, xmax, ymax, zmax] (inclusive). With an up to date 
+    chunk index only the intersecting blocks are read from the memory map,
+    otherwise the whole file is scanned chunk by chunk.
+    """
+
+    if len(bbox) == 4:
+        where = {'x':(bbox[0], bbox[2]), 'y':(bbox[1], bbox[3])}
+    else:
+        where = {'x':(bbox[0], bbox[3]), 'y':(bbox[1], bbox[4]), 'z':(bbox[2], bbox[5])}
+
+    index = read_index(fp)
+    if index is None:
+        return read_ply(fp, columns=columns, as_array=as_array, where=where)
+
+    hit = np.ones(len(index), dtype=bool)
+    for c, (lo, hi) in where.items():
+        hit &= (index[f'{c}max'] >= lo) & (index[f'{c}min'] <= hi)
+
+    arr, names, quant = vertices(fp, columns)
+    chunks = []
+    # read runs of consecutive intersecting blocks in one slice
+    blocks = np.flatnonzero(hit)
+    for run in np.split(blocks, np.flatnonzero(np.diff(blocks) > 1) + 1):
+        if len(run) == 0:
+            continue
+        start = int(index['start'][run[0]])
+        stop = int(index['start'][run[-1]] + index['count'][run[-1]])
+        chunks += list(iter_chunks(fp, arr[start:stop], names, where=where, quant=quant))
+    out = np.concatenate(chunks) if chunks else select(arr[:0], names, quant=quant)
+
+    if as_array:
+        return out
+
+    import pandas as pd
+    return pd.DataFrame({c: out[c] for c in out.dtype.names})
+
+def write_ply(output_name, pc, comments=None, quant=None):
+
+    with PlyWriter(output_name, ply_schema(pc), comments, quant=quant) as ply:
+        ply.write(pc)
 
 if __name__ == '__main__':
 
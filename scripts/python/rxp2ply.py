@@ -8,64 +8,116 @@ import glob
 import multiprocessing as mp
 import json
 import argparse
+import resource
+import hashlib
+import queue
+import collections
+import functools
 
-import pandas as pd
 import numpy as np
-import geopandas as gp
-from shapely.geometry import Point
 
 import ply_io
+import tiling
+import metrics
+import downsample
 import pdal
 
 
-def tile_data(scan_pos, args, tile_locks):
+# Worker state, set once per process by init_worker. Workers only import what tiling
+# needs, geopandas and shapely are imported by main in the parent.
+log_lock = None
+tile_grid = None
+matrices = {}
+
+
+def init_worker(lock, grid_file=None, matrix_file=None, matrix_names=()):
+    # lock serialises log messages, the tile lookup grid and the matrix table are
+    # memory mapped from the .npy files published by the parent
+    global log_lock, tile_grid, matrices
+    log_lock = lock
+    if grid_file is not None:
+        tile_grid = np.load(grid_file, mmap_mode='r')
+    if matrix_file is not None:
+        matrices = dict(zip(matrix_names, np.load(matrix_file, mmap_mode='r')))
+
+
+def find_rxp(scan_pos, args):
+    # Latest rxp file of a scan position, None if there is none
+    base, scan = os.path.split(scan_pos)
+    pattern = '??????_??????.mon.rxp' if args.test else '??????_??????.rxp'
+    rxp = sorted(glob.glob(os.path.join(base, scan, 'scans' if 'SCNPOS' in scan else '', pattern)))
+    return rxp[-1] if len(rxp) > 0 else None
+
+
+def matrix_files(matrix_dir):
+    # Rotation matrix file of each scan name in matrix_dir, from a single directory listing
+    files = {}
+    for fn in sorted(os.listdir(matrix_dir)):
+        files.setdefault(fn.split('.')[0], os.path.join(matrix_dir, fn))
+    return files
+
+
+def find_matrix(scan_pos, args):
+    # Rotation matrix file of a scan position, None if there is none
+    return args.matrix_files.get(os.path.basename(scan_pos).replace('.SCNPOS', '').split('.')[0])
+
+
+def worker_args(args):
+    # The subset of args that workers use, keeps the per task pickle small and free of geopandas objects
+    keep = [
+        'odir', 'plot_code', 'n', 'prefix', 'matrix_dir', 'deviation', 'reflectance', 'tile', 'bbox',
+        'chunk_size', 'write_buffer', 'tmp_codec', 'sort', 'downsample', 'downsample_dir',
+        'no_full_resolution', 'block_size', 'quantise', 'z_offset', 'verbose', 'log_file',
+    ]  # fmt: skip
+    return argparse.Namespace(**{k: getattr(args, k) for k in keep})
+
+
+def scan_sp(scan_pos, args):
+    # Scan position number used for the sp field and shard names
+    return int(os.path.basename(scan_pos).replace(args.prefix, '').replace('.SCNPOS', ''))
+
+
+def tile_data(scan_pos, rxp, args):
     # Get the scan name to use in log_file messages so that they are not too long:
     scan_name = os.path.basename(scan_pos)
     # Record the start time
     start_time = datetime.now()
+    result = {'scan': scan_name, 'status': 'failed', 'tiles': [], 'runtime': 0}
+    timer = metrics.StageTimer()
+    reset_peak_rss()
     if args.verbose:
-        with args.Lock:
+        with log_lock:
             msg = f'[{datetime.now().strftime("%H:%M:%S")}] Worker started for scan: {scan_name}'
             print(msg)
             write_to_log(msg, args.log_file)
 
     try:
         base, scan = os.path.split(scan_pos)
-        try:
-            if args.test:
-                rxp = sorted(
-                    glob.glob(os.path.join(base, scan, 'scans' if 'SCNPOS' in scan else '', '??????_??????.mon.rxp'))
-                )[-1]
-            else:
-                rxp = sorted(
-                    glob.glob(os.path.join(base, scan, 'scans' if 'SCNPOS' in scan else '', '??????_??????.rxp'))
-                )[-1]
-        except:
+        if rxp is None:
             if args.verbose:
-                with args.Lock:
+                with log_lock:
                     msg = f"!!! Can't find {os.path.join(base, scan, '??????_??????.rxp')} !!!"
                     print(msg)
                     write_to_log(msg, args.log_file)
-            return
+            return result
 
-        sp = int(scan.replace(args.prefix, '').replace('.SCNPOS', ''))
+        sp = scan_sp(scan_pos, args)
 
         if args.verbose:
-            with args.Lock:
+            with log_lock:
                 rxp_name = os.path.basename(rxp)
                 msg = f'rxp -> xyz for scan pos {scan_name}: {rxp_name}'
                 print(msg)
                 write_to_log(msg, args.log_file)
 
-        fn_matrix = glob.glob(os.path.join(args.matrix_dir, f'{scan.replace(".SCNPOS", "")}.*'))
-        if len(fn_matrix) == 0:
+        if scan_name not in matrices:
             if args.verbose:
-                with args.Lock:
+                with log_lock:
                     msg = f"!!! Can not find rotation matrix: {os.path.join(args.matrix_dir, scan.replace('.SCNPOS', '') + '.*')} !!!"
                     print(msg)
                     write_to_log(msg, args.log_file)
-            return
-        matrix = np.dot(args.global_matrix, np.loadtxt(fn_matrix[0]))
+            return result
+        matrix = matrices[scan_name]
         st_matrix = ' '.join(matrix.flatten().astype(str))
 
         cmds = []
@@ -83,65 +135,86 @@ def tile_data(scan_pos, args, tile_locks):
         transform = {'type': 'filters.transformation', 'matrix': st_matrix}
         cmds.append(transform)
 
-        tile = {'type': 'filters.splitter', 'length': f'{args.tile}', 'origin_x': '0', 'origin_y': '0'}
-        cmds.append(tile)
-
         # link commmands and pass to pdal
         JSON = json.dumps(cmds)
         pipeline = pdal.Pipeline(JSON)
 
+        if args.chunk_size > 0 and not pipeline.streamable and args.verbose:
+            with log_lock:
+                msg = f'pipeline for {scan_name} is not streamable, reading the whole scan'
+                print(msg)
+                write_to_log(msg, args.log_file)
 
-        pipeline.execute()
-
-        # iterate over tiled arrays
-        for arr in pipeline.arrays:
-            arr = pd.DataFrame(arr)
-            arr = arr.rename(columns={'X': 'x', 'Y': 'y', 'Z': 'z'})
-            # arr.columns = ['x', 'y', 'z', 'InternalTime', 'ReturnNumber', 'NumberOfReturns',
-            #               'amp', 'refl', 'EchoRange', 'dev', 'BackgroundRadiation',
-            #               'IsPpsLocked', 'EdgeOfFlightLine']
-            arr.loc[:, 'sp'] = sp
-            arr = arr[
-                ['x', 'y', 'z', 'Reflectance', 'Deviation', 'ReturnNumber', 'NumberOfReturns', 'sp']
-            ]  # save only relevant fields
-
-            # remove points outside bbox
-            arr = arr.loc[(arr.x.between(args.bbox[0], args.bbox[2])) & (arr.y.between(args.bbox[1], args.bbox[3]))]
-            if len(arr) == 0:
-                continue
-
-            # identify tile number
-            X, Y = (arr[['x', 'y']].min() // args.tile * args.tile).astype(int)
-            tile = args.tiles.loc[(args.tiles.x == X) & (args.tiles.y == Y)]
-            if len(tile) == 0:
-                continue
-            tile_n = str(tile.tile.item()).zfill(args.n)
-            tile_number = tile.tile.item()
-
-            # save to xyz file
-            with tile_locks[tile_number]:
-                if args.store_tmp_with_sp:
-                    with open(os.path.join(args.odir, f'{args.plot_code}{tile_n}.{sp}.xyz'), 'ab') as fh:
-                        fh.write(arr.to_records(index=False).tobytes())
-                else:
-                    with open(os.path.join(args.odir, f'{args.plot_code}{tile_n}.xyz'), 'ab') as fh:
-                        fh.write(arr.to_records(index=False).tobytes())
+        # bucket points into tiles one chunk at a time, each worker appends to its own per-scan shards
+        # which are only committed once the whole scan has been written
+        # (read covers the PDAL reader, range filters and transformation, which run as one pipeline)
+        # the writer also keeps the statistics of each shard, of the decoded coordinates when quantised
+        flush_bytes = args.write_buffer * 2**20
+        quant = None
+        if args.quantise:
+            origins = tiling.tile_origins(tile_grid, args.bbox, args.tile)
+            quant = functools.partial(
+                tiling.tile_quantisation, origins=origins, scale=args.quantise, z_offset=args.z_offset
+            )
+        with tiling.ShardWriter(args.odir, args.plot_code, sp, args.n, flush_bytes, args.tmp_codec, quant) as writer:
+            chunks = read_scan(pipeline, args.chunk_size)
+            while True:
+                with timer('read'):
+                    arr = next(chunks, None)
+                if arr is None:
+                    break
+                tiles = tiling.split_tiles(
+                    arr,
+                    sp,
+                    tile_grid,
+                    args.bbox,
+                    args.tile,
+                    timer=timer,
+                    quantise=args.quantise,
+                    z_offset=args.z_offset,
+                )
+                for tile_number, records in tiles:
+                    writer.write(tile_number, records)
+
+        result['status'] = 'done'
+        result['tiles'] = sorted(f'{args.plot_code}{str(t).zfill(args.n)}' for t in writer.tiles)
 
         # Record the end time
         end_time = datetime.now()
         # Calculate the execution time
+        result['runtime'] = (end_time - start_time).total_seconds()
+        timer.add('write_wait', writer.wait_seconds)
+        timer.add('write', writer.write_seconds)
+        result['metrics'] = {
+            'type': 'scan',
+            'scan': scan_name,
+            'started': start_time.isoformat(timespec='seconds'),
+            'runtime': result['runtime'],
+            'stages': {stage: round(seconds, 3) for stage, seconds in timer.stages.items()},
+            'points': sum(writer.points.values()),
+            'bytes': sum(writer.bytes.values()),
+            'compressed_bytes': sum(writer.compressed.values()),
+            'tiles': {
+                f'{args.plot_code}{str(t).zfill(args.n)}': [writer.points[t], writer.bytes[t]]
+                for t in sorted(writer.tiles)
+            },
+            'peak_rss_mb': round(peak_rss()),
+        }
 
         if args.verbose:
-            with args.Lock:
+            with log_lock:
                 msg1 = f'[{datetime.now().strftime("%H:%M:%S")}] Worker finished for scan: {scan_name}'
                 msg2 = f'Runtime: {calculate_execution_time(start_time, end_time)}'
+                msg3 = f'Peak RSS: {peak_rss():.0f} MB'
                 print(msg1)
                 print(msg2)
+                print(msg3)
                 write_to_log(msg1, args.log_file)
                 write_to_log(msg2, args.log_file)
+                write_to_log(msg3, args.log_file)
 
     except Exception as e:
-        with args.Lock:
+        with log_lock:
             msg1 = f'!!!! {scan_pos} !!!!'
             msg2 = f'{e}'
             print(msg1)
@@ -149,70 +222,323 @@ def tile_data(scan_pos, args, tile_locks):
             write_to_log(msg1, args.log_file)
             write_to_log(msg2, args.log_file)
 
+    return result
 
-def xyz2ply_w_sp(xyz, args):
-    start_time = datetime.now()
-
-    xyz = str(xyz).zfill(args.n)
 
-    if args.verbose:
-        with args.Lock:
-            msg = f'Worker process started for sp.xyz -> ply: {xyz}'
-            print(msg)
-            write_to_log(msg, args.log_file)
-
-    tmp = pd.DataFrame()
-
-    for fn in glob.glob(os.path.join(args.odir, f'{xyz}.*.xyz')):
-        open_file = open(fn, encoding='ISO-8859-1')
-        tmp = pd.concat(
-            [
-                tmp,
-                pd.DataFrame(np.fromfile(open_file, dtype='float64,float64,float64,float32,float32,uint8,uint8,int64')),
-            ]
-        )
-        os.unlink(fn)
-
-    if len(tmp) > 0:
-        tmp.columns = ['x', 'y', 'z', 'refl', 'dev', 'ReturnNumber', 'NumberOfReturns', 'sp']
-        ply_io.write_ply(os.path.join(args.odir, f'{xyz}.ply'), tmp)
-
-    end_time = datetime.now()
-    if args.verbose:
-        with args.Lock:
-            msg1 = f'Worker process ended for xyz -> ply: {xyz}'
-            msg2 = f'Runtime: {calculate_execution_time(start_time, end_time)}'
-            print(msg1)
-            print(msg2)
-            write_to_log(msg1, args.log_file)
-            write_to_log(msg2, args.log_file)
+def read_scan(pipeline, chunk_size):
+    # Yield the scan as PDAL arrays, streamed in chunks of chunk_size points when the pipeline allows it
+    if chunk_size > 0 and pipeline.streamable:
+        yield from pipeline.iterator(chunk_size=chunk_size)
+    else:
+        pipeline.execute()
+        yield from pipeline.arrays
 
 
-def xyz2ply(xyz_path, args):
+def xyz2ply(tile_name, shards, replace, args):
     start_time = datetime.now()
 
     if args.verbose:
-        with args.Lock:
-            msg = f'Worker process started for xyz -> ply: {xyz_path}'
+        with log_lock:
+            msg = f'Worker process started for xyz -> ply: {tile_name}'
             print(msg)
             write_to_log(msg, args.log_file)
 
-    open_file = open(xyz_path, encoding='ISO-8859-1')
-    tmp = pd.DataFrame(np.fromfile(open_file, dtype='float64,float64,float64,float32,float32,uint8,uint8,int64'))
-    tmp.columns = ['x', 'y', 'z', 'refl', 'dev', 'ReturnNumber', 'NumberOfReturns', 'sp']
-    ply_io.write_ply(xyz_path.replace('.xyz', '.ply'), tmp)
-    os.unlink(xyz_path)
+    ply = os.path.join(args.odir, f'{tile_name}.ply')
+
+    # record layout of the tile and, when quantised, the scale and offsets of its coordinates
+    dtype = tiling.record_dtype(args.quantise)
+    quant = {}
+    if args.quantise:
+        origins = tiling.tile_origins(tile_grid, args.bbox, args.tile)
+        quant = tiling.tile_quantisation(int(tile_name[len(args.plot_code) :]), origins, args.quantise, args.z_offset)
+
+    # keep the points of an existing tile that do not come from the scans being replaced,
+    # replace is None when the existing tile is out of date as a whole
+    kept = np.empty(0, dtype=dtype)
+    if replace is not None and os.path.isfile(ply):
+        _, count, body_dtype, offset, _ = ply_io.read_ply_header(ply)
+        body = np.memmap(ply, dtype=body_dtype, mode='r', offset=offset, shape=(count,))
+        mask = ~np.isin(body['sp'], replace)
+        kept = np.empty(mask.sum(), dtype=dtype)
+        for name in dtype.names:
+            kept[name] = body[name][mask]
+        del body
+
+    # prepend a PLY header to the kept points and the per scan position shards of this tile,
+    # whole records only, then swap the new tile into place
+    nbytes = [tiling.shard_nbytes(fn, dtype.itemsize) for fn in shards]
+    count = len(kept) + sum(nbytes) // dtype.itemsize
+    downsampled = []
+    if args.downsample:
+        # the finest length in downsample_dir, coarser levels in its pyramid directory as downsample.py writes them
+        downsampled = [os.path.join(args.downsample_dir, f'{tile_name}.downsample.ply')]
+        pyramid_dir = os.path.join(args.downsample_dir, 'pyramid')
+        downsampled += [downsample.level_path(downsampled[0], length, pyramid_dir) for length in args.downsample[1:]]
+    if count > 0 and (args.sort == 'morton' or args.downsample):
+        # the whole tile in memory, for the spatially ordered layout and/or the downsampled tile
+        records = [tiling.read_shard(fn, dtype, n) for fn, n in zip(shards, nbytes)]
+        records = np.concatenate([kept, *records])
+        if args.sort == 'morton':
+            records = records[ply_io.morton_order(records['x'], records['y'], records['z'])]
+        points = ply_io.select(records, dtype.names, quant=quant) if quant else records
+        if not args.no_full_resolution:
+            with ply_io.PlyWriter(ply + '.tmp', dtype, stats=False, quant=quant) as writer:
+                writer.write(records)
+            stats = ply_io.PlyStats()
+            stats.update(points)
+            os.replace(ply + '.tmp', ply)
+            if args.sort == 'morton':
+                ply_io.write_index(ply, records, args.block_size, quant)
+            elif os.path.isfile(ply_io.index_path(ply)):
+                os.unlink(ply_io.index_path(ply))
+            ply_io.write_stats(ply, stats)
+        if args.downsample:
+            # as downsample.py would from the tile just written, voxels counted from the tile's bounds minimum
+            origin = [points[c].min() for c in 'xyz']
+            levels = downsample.voxel_pyramid(points['x'], points['y'], points['z'], args.downsample, origin)
+            for fn, keep in zip(downsampled, levels):
+                with ply_io.PlyWriter(fn + '.tmp', dtype, quant=quant) as writer:
+                    writer.write(records[keep])
+                os.replace(fn + '.tmp', fn)
+                os.replace(ply_io.stats_path(fn + '.tmp'), ply_io.stats_path(fn))
+    elif count > 0:
+        with open(ply + '.tmp', 'wb') as fh:
+            ply_io.write_ply_header(fh, dtype, count, ply_io.quantisation_comments(quant))
+            kept.tofile(fh)
+            for fn, n in zip(shards, nbytes):
+                tiling.append_shard(fh, fn, n, dtype)
+        # summary statistics sidecar, merged from the kept points and the statistics saved with each shard
+        stats = ply_io.PlyStats()
+        stats.update(ply_io.select(kept, dtype.names, quant=quant) if quant else kept)
+        for fn, n in zip(shards, nbytes):
+            stats.merge(tiling.shard_stats(fn, dtype, n, quant))
+        os.replace(ply + '.tmp', ply)
+        ply_io.write_stats(ply, stats)
+        if os.path.isfile(ply_io.index_path(ply)):
+            os.unlink(ply_io.index_path(ply))
+    else:
+        for fn in (ply, ply_io.stats_path(ply), ply_io.index_path(ply)):
+            if os.path.isfile(fn):
+                os.unlink(fn)
+        for fn in downsampled + [ply_io.stats_path(fn) for fn in downsampled]:
+            if os.path.isfile(fn):
+                os.unlink(fn)
 
     end_time = datetime.now()
+    result = {
+        'type': 'tile',
+        'tile': tile_name,
+        'started': start_time.isoformat(timespec='seconds'),
+        'runtime': (end_time - start_time).total_seconds(),
+        'points': count,
+        'bytes': count * dtype.itemsize,
+        'kept': len(kept),
+        'shards': len(shards),
+        'downsampled': len(levels[0]) if count > 0 and args.downsample else 0,
+        # the shards now in the tile, removed by the parent once the manifest records the tile,
+        # so a run stopped in between converts the tile again from the same shards
+        'merged': list(shards),
+    }
     if args.verbose:
-        with args.Lock:
-            msg1 = f'Worker process ended for xyz -> ply: {xyz_path}'
+        with log_lock:
+            msg1 = f'Worker process ended for xyz -> ply: {tile_name}'
             msg2 = f'Runtime: {calculate_execution_time(start_time, end_time)}'
             print(msg1)
             print(msg2)
             write_to_log(msg1, args.log_file)
             write_to_log(msg2, args.log_file)
 
+    return result
+
+
+def find_shards(odir):
+    # Group the committed .xyz and .xyzc shards in odir by tile with a single directory scan
+    shards = {}
+    for entry in os.scandir(odir):
+        if entry.name.endswith(('.xyz', '.xyzc')):
+            shards.setdefault(entry.name.split('.')[0], []).append(entry.path)
+    return {tile_name: sorted(paths) for tile_name, paths in sorted(shards.items())}
+
+
+def shard_sp(path):
+    # Scan position number of a {tile}.{sp}.xyz shard
+    return int(os.path.basename(path).split('.')[-2])
+
+
+def remove_stale_files(odir, sps, own_sps=None):
+    """
+    Remove uncommitted parts and temporary tiles left by a crashed run, and the
+    shards of the scans in sps that are about to be redone. An array task passes
+    its own scans as own_sps so it never touches files other tasks are writing.
+    """
+    for entry in os.scandir(odir):
+        if entry.name.endswith(('.xyz.part', '.xyzc.part')) and (
+            own_sps is None or shard_sp(entry.path[:-5]) in own_sps
+        ):
+            os.unlink(entry.path)
+        elif entry.name.endswith('.ply.tmp') and own_sps is None:
+            os.unlink(entry.path)
+        elif entry.name.endswith(('.xyz', '.xyzc')) and shard_sp(entry.path) in sps:
+            os.unlink(entry.path)
+        elif entry.name.endswith(('.xyz.stats.json', '.xyzc.stats.json')) and shard_sp(entry.path[:-11]) in sps:
+            os.unlink(entry.path)
+
+
+def run_settings(args):
+    # Settings that change the content of every tile, a change means all scans are redone
+    return {
+        'deviation': args.deviation,
+        'reflectance': list(args.reflectance),
+        'tile': args.tile,
+        'bbox': [float(b) for b in args.bbox],
+        'global_matrix': np.asarray(args.global_matrix).tolist(),
+        'prefix': args.prefix,
+        'plot_code': args.plot_code,
+        'test': args.test,
+        'quantise': args.quantise,
+        'z_offset': args.z_offset,
+        'downsample': args.downsample,
+        'no_full_resolution': args.no_full_resolution,
+    }
+
+
+def scan_signature(scan_pos, args):
+    # What a completed scan was made from, the scan is redone when any of it changes
+    rxp = find_rxp(scan_pos, args)
+    fn_matrix = find_matrix(scan_pos, args)
+    signature = {'rxp': rxp, 'size': None, 'mtime': None, 'matrix_hash': None}
+    if rxp is not None:
+        stat = os.stat(rxp)
+        signature['size'] = stat.st_size
+        signature['mtime'] = stat.st_mtime
+    if fn_matrix is not None:
+        with open(fn_matrix, 'rb') as fh:
+            signature['matrix_hash'] = hashlib.sha1(fh.read()).hexdigest()
+    return signature
+
+
+def scan_position(scan_pos, args):
+    # x, y of a scan position from its rotation matrix (global matrix applied), nan when there is no matrix
+    fn_matrix = find_matrix(scan_pos, args)
+    if fn_matrix is None:
+        return [np.nan, np.nan]
+    return np.dot(args.global_matrix, np.loadtxt(fn_matrix))[:2, 3]
+
+
+def tile_dependencies(scan_xy, tile_xy, length, max_range):
+    # (scan, tile) boolean matrix of the tiles within max_range of each scan, all tiles when there is no range
+    deps = np.ones((len(scan_xy), len(tile_xy)), dtype=bool)
+    if max_range is None:
+        return deps
+    sx, sy = scan_xy[:, None, 0], scan_xy[:, None, 1]
+    tx, ty = tile_xy[None, :, 0], tile_xy[None, :, 1]
+    dx = np.maximum(np.maximum(tx - sx, sx - (tx + length)), 0)
+    dy = np.maximum(np.maximum(ty - sy, sy - (ty + length)), 0)
+    known = ~np.isnan(scan_xy).any(axis=1)
+    deps[known] = np.hypot(dx, dy)[known] <= max_range
+    return deps
+
+
+def scan_costs(todo, history):
+    """
+    Expected runtime of each (scan_pos, signature, previous_tiles) task: the
+    runtime observed in an earlier run when history has one, otherwise the rxp
+    size scaled by the median seconds per byte of the scans with history.
+    """
+    sizes = np.array([signature['size'] or 0 for _, signature, _ in todo], dtype=float)
+    observed = np.array([history.get(os.path.basename(scan_pos), np.nan) for scan_pos, _, _ in todo], dtype=float)
+    known = ~np.isnan(observed) & (sizes > 0)
+    rate = np.median(observed[known] / sizes[known]) if known.any() else 1.0
+    return np.where(np.isnan(observed), sizes * rate, observed)
+
+
+def parse_shard(shard):
+    # (index, count) from 'i/N', or from the Slurm array environment for 'slurm'
+    if shard == 'slurm':
+        index = int(os.environ['SLURM_ARRAY_TASK_ID']) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+        return index, int(os.environ['SLURM_ARRAY_TASK_COUNT'])
+    index, count = (int(v) for v in shard.split('/'))
+    if not 0 <= index < count:
+        raise Exception(f'--shard {shard}: index must be between 0 and {count - 1}')
+    return index, count
+
+
+def shard_scans(scan_list, index, count, args):
+    """
+    Scan positions of shard index out of count. Scans are dealt largest rxp first
+    to the least loaded shard, ties broken by name, so every array task derives
+    the same balanced partition without talking to the others.
+    """
+    sizes = []
+    for scan_pos in scan_list:
+        rxp = find_rxp(scan_pos, args)
+        sizes.append((-(os.path.getsize(rxp) if rxp else 0), os.path.basename(scan_pos), scan_pos))
+    loads = [0] * count
+    counts = [0] * count
+    mine = []
+    for size, _, scan_pos in sorted(sizes):
+        i = min(range(count), key=lambda k: (loads[k], counts[k]))
+        loads[i] -= size
+        counts[i] += 1
+        if i == index:
+            mine.append(scan_pos)
+    return sorted(mine)
+
+
+def merge_manifests(manifest, shard_files):
+    # Fold the manifests written by array tasks into the run manifest
+    for fn in shard_files:
+        shard = load_manifest(fn)
+        if shard.get('settings') != manifest['settings']:
+            raise Exception(f'{fn} was written with different settings, rerun the array tasks or use --force')
+        manifest['fresh'] = manifest['fresh'] or shard['fresh']
+        for scan in shard['partition']:
+            if scan in shard['scans']:
+                manifest['scans'][scan] = shard['scans'][scan]
+        for tile_name, sps in shard['pending'].items():
+            pending = manifest['pending'].setdefault(tile_name, sps)
+            if pending is None or sps is None:
+                manifest['pending'][tile_name] = None
+            else:
+                manifest['pending'][tile_name] = sorted(set(pending) | set(sps))
+        manifest.setdefault('history', {}).update(shard.get('history', {}))
+    return manifest
+
+
+def check_tiles(manifest, odir):
+    # (tile, expected, found) for every converted tile whose point count differs from the sum over its scans
+    scans = manifest['scans'].values()
+    if any(entry['status'] != 'done' or 'points' not in entry for entry in scans):
+        return []
+    expected = {}
+    for entry in scans:
+        for tile_name, n in entry['points'].items():
+            expected[tile_name] = expected.get(tile_name, 0) + n
+    mismatches = []
+    for tile_name, n in sorted(expected.items()):
+        ply = os.path.join(odir, f'{tile_name}.ply')
+        if tile_name in manifest['pending']:
+            continue
+        found = ply_io.read_ply_header(ply)[1] if os.path.isfile(ply) else 0
+        if found != n:
+            mismatches.append((tile_name, n, found))
+    return mismatches
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(manifest, path):
+    # Write to a temporary file and rename so a crash never leaves a half written manifest
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + '.tmp', path)
+
 
 def calculate_execution_time(start_time, end_time):
     # Calculate the execution time
@@ -227,6 +553,28 @@ def calculate_execution_time(start_time, end_time):
     return execution_time_str
 
 
+def reset_peak_rss():
+    # Start a new peak_rss for this task, workers live for many tasks and would otherwise report their largest so far
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss():
+    # Peak resident set size of this process in MB since reset_peak_rss (VmHWM), where there is no /proc
+    # the peak over the whole life of the process (ru_maxrss, in KB on Linux)
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
 def write_to_log(message, log_file):
     if log_file:
         with open(log_file, 'a') as f:
@@ -234,6 +582,9 @@ def write_to_log(message, log_file):
 
 
 def main():
+    import geopandas as gp
+    from shapely.geometry import Point, Polygon
+
     parser = argparse.ArgumentParser()
     parser.add_argument('--project', '-p', required=True, type=str, help='path to point cloud')
     parser.add_argument('--matrix-dir', '-m', type=str, default='', help='path to rotation matrices')
@@ -259,9 +610,91 @@ def main():
     parser.add_argument('--pos', default=[], nargs='*', help='process using specific scan positions')
     parser.add_argument('--test', action='store_true', help='test using the .mon.rxp')
     parser.add_argument(
-        '--store-tmp-with-sp', action='store_true', help='spits out individual tmp files for tiles _and_ scan position'
+        '--store-tmp-with-sp',
+        action='store_true',
+        help='deprecated, tmp files are always written per tile and scan position',
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=0, help='stream scans in chunks of this many points, 0 reads whole scans'
+    )
+    parser.add_argument('--write-buffer', type=int, default=64, help='MB of tile records buffered per worker write')
+    parser.add_argument(
+        '--tmp-codec',
+        choices=['none', 'zlib', 'zstd', 'lz4'],
+        default='none',
+        help='compress the temporary shards, zstd and lz4 need the zstandard and lz4 packages',
+    )
+    parser.add_argument(
+        '--sort',
+        choices=['none', 'morton'],
+        default='none',
+        help='morton: write tiles in Z-order with a chunk index so ply_io.read_region reads only the blocks it needs',
+    )
+    parser.add_argument('--block-size', type=int, default=65536, help='points per block of the --sort chunk index')
+    parser.add_argument(
+        '--quantise',
+        type=float,
+        default=0,
+        help='store tile coordinates as int32 steps of this many m (e.g. 0.001) from the tile corner, '
+        'such tiles are decoded by ply_io but not by PDAL, 0 keeps float64',
+    )
+    parser.add_argument('--z-offset', type=float, default=0, help='z origin of --quantise coordinates')
+    parser.add_argument(
+        '--downsample',
+        type=float,
+        nargs='+',
+        default=[],
+        help='also write each tile voxel downsampled to this length, as downsample.py --length would, '
+        'several lengths give a pyramid of levels',
+    )
+    parser.add_argument(
+        '--downsample-dir',
+        type=str,
+        default='',
+        help='directory of the --downsample tiles, default a downsample directory next to --odir',
+    )
+    parser.add_argument(
+        '--no-full-resolution',
+        action='store_true',
+        help='only write the --downsample tiles, any change to the scans then reprocesses all of them',
+    )
+    parser.add_argument(
+        '--max-range',
+        type=float,
+        default=None,
+        help='maximum range of the scanner in m, lets tiles out of range of outstanding scans be converted early',
+    )
+    parser.add_argument(
+        '--schedule',
+        choices=['size', 'history', 'name'],
+        default='size',
+        help='order scans by rxp size, by runtimes recorded in the manifest (size when unknown) or by name',
+    )
+    parser.add_argument(
+        '--maxtasksperchild',
+        type=int,
+        default=0,
+        help='replace a worker after this many tasks, 0 keeps workers for the whole run',
+    )
+    parser.add_argument(
+        '--shard',
+        type=str,
+        default='',
+        help='i/N: tile only the i-th of N partitions of the scans and leave the tiles to --merge, '
+        'slurm: take i and N from the Slurm array environment',
+    )
+    parser.add_argument(
+        '--merge', action='store_true', help='merge the output of --shard array tasks into tiles and tile_index.dat'
     )
+    parser.add_argument('--force', action='store_true', help='reprocess all scans, ignoring the manifest in --odir')
     parser.add_argument('--log-file', type=str, default='', help='log file')
+    parser.add_argument(
+        '--metrics-file',
+        type=str,
+        default='',
+        help='per scan and tile timings as JSON lines, '
+        'defaults to <log-file>.metrics.jsonl or <odir>/rxp2ply.metrics.jsonl',
+    )
     parser.add_argument('--verbose', action='store_true', help='print something')
 
     args = parser.parse_args()
@@ -283,13 +716,36 @@ def main():
     # find and read rotation matrix
     if not os.path.isdir(args.matrix_dir):
         raise Exception(f'no such directory: {args.matrix_dir}')
-    M = glob.glob(os.path.join(args.matrix_dir, f'{args.prefix}*.*'))
+    args.matrix_files = matrix_files(args.matrix_dir)
+    M = [fn for name, fn in args.matrix_files.items() if name.startswith(args.prefix)]
     if len(M) == 0:
         raise Exception('no matrix files found, ensure they are named correctly')
     matrix_arr = np.zeros((len(M), 3))
     for i, m in enumerate(M):
         matrix_arr[i, :] = np.loadtxt(m)[:3, 3]
 
+    if args.shard and args.merge:
+        raise Exception('--shard and --merge are separate stages, run the array tasks first and then --merge')
+    if args.no_full_resolution and not args.downsample:
+        raise Exception('--no-full-resolution needs --downsample')
+    if args.no_full_resolution and (args.shard or args.merge):
+        raise Exception(
+            '--no-full-resolution cannot be used with --shard, changed scans are merged into the full tiles'
+        )
+    if args.downsample:
+        args.downsample = sorted(set(args.downsample))
+        if not args.downsample_dir:
+            args.downsample_dir = os.path.join(os.path.dirname(os.path.abspath(args.odir)), 'downsample')
+        os.makedirs(args.downsample_dir, exist_ok=True)
+        if len(args.downsample) > 1:
+            os.makedirs(os.path.join(args.downsample_dir, 'pyramid'), exist_ok=True)
+    if args.no_full_resolution:
+        # a tile converted early could not take the points of a late scan without its full resolution points
+        args.max_range = None
+    if args.tmp_codec != 'none':
+        # fail before any scan is read if the codec's package is missing
+        tiling.get_codec(args.tmp_codec)
+
     # bbox [xmin, ymin, xmax, ymax]
     if args.bounding_geometry and len(args.bbox) > 0:
         raise Exception('a bounding geometry and bounding box have been specified')
@@ -328,7 +784,7 @@ def main():
     args.bbox = (extent.exterior.bounds.values[0] // args.tile) * args.tile
     if args.verbose:
         print('bounding box:', args.bbox)
-    if args.save_bounding_geometry:
+    if args.save_bounding_geometry and not args.shard:
         extent.to_file(args.save_bounding_geometry)
         if args.verbose:
             msg = f'bounding geometry saved to {args.save_bounding_geometry}'
@@ -360,41 +816,243 @@ def main():
         args.ScanPos = list(args.pos) if len(args.pos) == 1 else args.pos
         # args.ScanPos = [os.path.join(args.project, p) for p in args.pos]
 
-    # write tile index
-    args.tiles[['tile', 'x', 'y']].to_csv(os.path.join(args.odir, 'tile_index.dat'), sep=' ', index=False, header=False)
+    # write tile index, left to the merge stage when running as an array task
+    if not args.shard:
+        args.tiles[['tile', 'x', 'y']].to_csv(
+            os.path.join(args.odir, 'tile_index.dat'), sep=' ', index=False, header=False
+        )
     if args.bbox_only:
         sys.exit()
 
-    # read in and tile scans
-    mp.set_start_method('spawn')
-    m = mp.Manager()
-    # Create an array of locks, one per tile, number of tiles is args.n
-    tile_locks = [m.Lock() for _ in range(args.tile_count + 1)]
-
-    args.Lock = m.Lock()
-    # [tile_data(sp, args) for sp in np.sort(args.ScanPos)]
-
-    with mp.Pool(processes=args.num_prcs, maxtasksperchild=1) as pool:
-        tile_args = [(sp, args, tile_locks) for sp in np.sort(args.ScanPos)]
-
-        async_results = pool.starmap_async(tile_data, tile_args, error_callback=lambda e: print(e))
-        async_results.wait()
-
+    # an array task only tiles its own scans and keeps its own manifest, the merge stage converts the tiles
+    manifest_path = os.path.join(args.odir, 'rxp2ply_manifest.json')
+    suffix = ''
+    own_sps = None
+    if args.shard:
+        index, count = parse_shard(args.shard)
+        args.ScanPos = shard_scans(args.ScanPos, index, count, args)
+        own_sps = {scan_sp(scan_pos, args) for scan_pos in args.ScanPos}
+        suffix = f'.shard-{index}-of-{count}'
         if args.verbose:
-            with args.Lock:
-                msg = 'Finished processing all scan positions'
-                print(msg)
-                write_to_log(msg, args.log_file)
+            msg = f'shard {index}/{count}: {len(args.ScanPos)} scan positions'
+            print(msg)
+            write_to_log(msg, args.log_file)
+
+    if not args.metrics_file:
+        if args.log_file:
+            args.metrics_file = os.path.splitext(args.log_file)[0] + f'{suffix}.metrics.jsonl'
+        else:
+            args.metrics_file = os.path.join(args.odir, f'rxp2ply{suffix}.metrics.jsonl')
+
+    # compare scans against the manifest of previous runs, only new, changed or failed scans are processed
+    manifest = load_manifest(manifest_path)
+    if args.shard and os.path.isfile(manifest_path.replace('.json', f'{suffix}.json')):
+        manifest = load_manifest(manifest_path.replace('.json', f'{suffix}.json'))
+    settings = run_settings(args)
+    if args.force or manifest.get('settings') != settings:
+        history = manifest.get('history', {})
+        manifest = {'settings': settings, 'scans': {}, 'pending': {}, 'fresh': True, 'history': history}
+    if args.shard:
+        manifest['partition'] = [os.path.basename(scan_pos) for scan_pos in args.ScanPos]
+        manifest_path = manifest_path.replace('.json', f'{suffix}.json')
+    if args.merge:
+        shard_files = sorted(glob.glob(os.path.join(args.odir, 'rxp2ply_manifest.shard-*-of-*.json')))
+        manifest = merge_manifests(manifest, shard_files)
+        save_manifest(manifest, manifest_path)
+        for fn in shard_files + glob.glob(os.path.join(args.odir, 'rxp2ply_*.shard-*-of-*.npy')):
+            os.unlink(fn)
+        args.ScanPos = []
+
+    todo = []
+    for scan_pos in np.sort(args.ScanPos):
+        signature = scan_signature(scan_pos, args)
+        entry = manifest['scans'].get(os.path.basename(scan_pos), {})
+        if entry.get('status') == 'done' and all(entry.get(k) == v for k, v in signature.items()):
+            continue
+        todo.append((scan_pos, signature, entry.get('tiles', [])))
+
+    # without full resolution tiles there is nothing to merge changed scans into, so every scan is redone
+    if args.no_full_resolution and 0 < len(todo) < len(args.ScanPos):
+        history = manifest.get('history', {})
+        manifest = {'settings': settings, 'scans': {}, 'pending': {}, 'fresh': True, 'history': history}
+        todo = [(scan_pos, scan_signature(scan_pos, args), []) for scan_pos in np.sort(args.ScanPos)]
+
+    # longest scans first so the big ones do not start last and leave the run waiting on one worker
+    if args.schedule != 'name':
+        costs = scan_costs(todo, manifest.get('history', {}) if args.schedule == 'history' else {})
+        todo = [task for _, task in sorted(zip(costs, todo), key=lambda ct: -ct[0])]
 
-        # write to ply - reusing Pool
-        if args.store_tmp_with_sp:
-            pool.starmap_async(xyz2ply_w_sp, [(xyz, args) for xyz in np.sort(args.tiles.tile)])
+    if args.verbose:
+        msg = f'{len(args.ScanPos) - len(todo)} scan positions up to date, {len(todo)} to process'
+        print(msg)
+        write_to_log(msg, args.log_file)
+
+    remove_stale_files(args.odir, {scan_sp(scan_pos, args) for scan_pos, _, _ in todo}, own_sps)
+    save_manifest(manifest, manifest_path)
+
+    # publish the tile lookup grid and the matrix of every scan once, workers memory map them
+    grid_file = os.path.join(args.odir, f'rxp2ply_tile_grid{suffix}.npy')
+    np.save(grid_file, tiling.tile_grid(args.tiles.x, args.tiles.y, args.tiles.tile, args.bbox, args.tile))
+    matrix_names = [os.path.basename(scan_pos) for scan_pos, _, _ in todo if find_matrix(scan_pos, args)]
+    matrix_file = os.path.join(args.odir, f'rxp2ply_matrices{suffix}.npy')
+    np.save(
+        matrix_file,
+        np.array(
+            [np.dot(args.global_matrix, np.loadtxt(find_matrix(name, args))) for name in matrix_names]
+        ).reshape(-1, 4, 4),
+    )
+    wargs = worker_args(args)
+
+    # tiles each outstanding scan can contribute to, a tile is converted as soon as none of its scans are left
+    tile_names = [f'{args.plot_code}{str(t).zfill(args.n)}' for t in args.tiles.tile]
+    scan_xy = np.array([scan_position(scan_pos, args) for scan_pos, _, _ in todo]).reshape(-1, 2)
+    deps = tile_dependencies(scan_xy, args.tiles[['x', 'y']].values.astype(float), args.tile, args.max_range)
+    scan_tiles = [
+        {tile_names[j] for j in np.flatnonzero(deps[i])} | set(previous_tiles)
+        for i, (_, _, previous_tiles) in enumerate(todo)
+    ]
+    waiting = {}
+    for i, tile_names_i in enumerate(scan_tiles):
+        for tile_name in tile_names_i:
+            waiting.setdefault(tile_name, set()).add(i)
+    shards = find_shards(args.odir)
+
+    events = queue.Queue()
+    scans = collections.deque(range(len(todo)))
+    ready = collections.deque()
+    converting = {}
+    late = {}
+    converted = set(manifest.setdefault('converted', []))
+    running = 0
+    scans_left = len(todo)
+
+    def release(tile_name):
+        # queue a tile for conversion once no outstanding scan can add to it
+        if args.shard or len(waiting.get(tile_name, ())) > 0 or tile_name in converting or tile_name in ready:
+            return
+        if tile_name in manifest['pending'] or tile_name in shards:
+            ready.append(tile_name)
+
+    def scan_done(i, result):
+        # record the scan in the manifest and release the tiles it was holding back
+        scan_pos, signature, previous_tiles = todo[i]
+        entry = dict(signature, status=result['status'], tiles=result['tiles'], runtime=result['runtime'])
+        if result['status'] == 'done':
+            entry['points'] = {tile_name: n for tile_name, (n, _) in result['metrics']['tiles'].items()}
+            sp = scan_sp(scan_pos, args)
+            for tile_name in set(previous_tiles) | set(result['tiles']):
+                # a fresh run rebuilds each existing tile as a whole, unless it was already converted in this run
+                stale = manifest['fresh'] and tile_name not in converted
+                pending = manifest['pending'].setdefault(tile_name, None if stale else [])
+                if pending is not None and sp not in pending:
+                    pending.append(sp)
+            for tile_name in result['tiles']:
+                shard = f'{tile_name}.{sp}{tiling.shard_extension(args.tmp_codec)}'
+                shards.setdefault(tile_name, []).append(os.path.join(args.odir, shard))
+                if tile_name in converting:
+                    # a scan reached further than --max-range, rebuild the tile again afterwards
+                    late.setdefault(tile_name, set()).add(sp)
+        else:
+            entry['tiles'] = previous_tiles
+        manifest['scans'][result['scan']] = entry
+        if result['status'] == 'done':
+            manifest.setdefault('history', {})[result['scan']] = result['runtime']
+        save_manifest(manifest, manifest_path)
+        for tile_name in scan_tiles[i] | set(result['tiles']):
+            waiting.get(tile_name, set()).discard(i)
+            release(tile_name)
+
+    def tile_done(tile_name, merged):
+        # shards are only removed once the manifest no longer needs them to redo the tile
+        remaining = [fn for fn in shards.pop(tile_name, []) if fn not in merged]
+        if len(remaining) > 0:
+            shards[tile_name] = remaining
+        if manifest['fresh'] and tile_name not in converted:
+            converted.add(tile_name)
+            manifest['converted'].append(tile_name)
+        if tile_name in late:
+            manifest['pending'][tile_name] = sorted(late.pop(tile_name))
+            release(tile_name)
         else:
-            xyz = glob.glob(os.path.join(args.odir, '*.xyz'))
-            pool.starmap_async(xyz2ply, [(xyz, args) for xyz in np.sort(xyz)])
+            manifest['pending'].pop(tile_name, None)
+        save_manifest(manifest, manifest_path)
+        for fn in merged:
+            for path in (fn, ply_io.stats_path(fn)):
+                if os.path.isfile(path):
+                    os.unlink(path)
 
-        pool.close()
-        pool.join()
+    for tile_name in sorted(set(manifest['pending']) | set(shards)):
+        release(tile_name)
+
+    # read in and tile scans, converting tiles to ply as they complete - one pool kept full for the whole run
+    mp.set_start_method('spawn')
+    lock = mp.Lock()
+    init_worker(lock)
+
+    with mp.Pool(
+        processes=args.num_prcs,
+        maxtasksperchild=args.maxtasksperchild or None,
+        initializer=init_worker,
+        initargs=(lock, grid_file, matrix_file, matrix_names),
+    ) as pool:
+        while scans or ready or running:
+            while running < args.num_prcs and (ready or scans):
+                if ready:
+                    # finished tiles go first, they free scratch space and unblock later steps
+                    tile_name = ready.popleft()
+                    replace = manifest['pending'].get(tile_name, [])
+                    if replace is not None:
+                        replace = sorted(set(replace) | {shard_sp(fn) for fn in shards.get(tile_name, [])})
+                    converting[tile_name] = list(shards.get(tile_name, []))
+                    pool.apply_async(
+                        xyz2ply,
+                        (tile_name, converting[tile_name], replace, wargs),
+                        callback=lambda r, t=tile_name: events.put(('tile', t, r)),
+                        error_callback=lambda e, t=tile_name: events.put(('tile', t, e)),
+                    )
+                else:
+                    i = scans.popleft()
+                    pool.apply_async(
+                        tile_data,
+                        (todo[i][0], todo[i][1]['rxp'], wargs),
+                        callback=lambda r, i=i: events.put(('scan', i, r)),
+                        error_callback=lambda e, i=i: events.put(('scan', i, e)),
+                    )
+                running += 1
+
+            kind, key, result = events.get()
+            running -= 1
+            if isinstance(result, Exception):
+                print(result)
+            if kind == 'scan':
+                if isinstance(result, Exception):
+                    result = {'scan': os.path.basename(todo[key][0]), 'status': 'failed', 'tiles': [], 'runtime': 0}
+                scan_done(key, result)
+                metrics.append_record(result.get('metrics'), args.metrics_file)
+                scans_left -= 1
+                if args.verbose and scans_left == 0:
+                    with log_lock:
+                        msg = 'Finished processing all scan positions'
+                        print(msg)
+                        write_to_log(msg, args.log_file)
+            else:
+                converting.pop(key)
+                if not isinstance(result, Exception):
+                    tile_done(key, result.pop('merged'))
+                    metrics.append_record(result, args.metrics_file)
+
+    # existing tiles can be merged into once a fresh run has completed every scan and tile
+    if manifest['fresh'] and len(manifest['pending']) == 0:
+        if all(entry['status'] == 'done' for entry in manifest['scans'].values()):
+            manifest['fresh'] = False
+            manifest.pop('converted', None)
+            save_manifest(manifest, manifest_path)
+
+    if not args.shard and not args.no_full_resolution:
+        for tile_name, expected, found in check_tiles(manifest, args.odir):
+            msg = f'!!! {tile_name}.ply holds {found} points, the scans in the manifest put {expected} in it !!!'
+            print(msg)
+            write_to_log(msg, args.log_file)
 
     end = datetime.now()
     msg = f'Total rxp2ply runtime: {calculate_execution_time(start, end)}'
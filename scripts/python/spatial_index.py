@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+Binary spatial index over the tiles of a plot, built from a tile_index.dat.
+
+Holds every tile's name, tile_index.dat centre, bbox [xmin, ymin, zmin, xmax, ymax, zmax],
+point count and path, plus a uniform grid hash of the tile bboxes, in one .npz file. Point,
+bbox and nearest tile queries then only touch the grid cells around the query, never the tiles.
+
+    python spatial_index.py build tile_index.dat
+    python spatial_index.py neighbours tile_index.npz 012 -k 7 --paths
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+import ply_io
+
+TILE_DTYPE = np.dtype(
+    [
+        ('tile', '<U64'),
+        ('x', '<f8'),
+        ('y', '<f8'),
+        ('z', '<f8'),
+        ('bbox', '<f8', (6,)),
+        ('count', '<i8'),
+    ]
+)
+
+
+def index_path(tile_index):
+    # tile_index.dat -> tile_index.npz
+    return os.path.splitext(tile_index)[0] + '.npz'
+
+
+def read_tile_index(fp):
+    """
+    Rows of a tile_index.dat as (tile, x, y, z, path), either tile_index.py's
+    'tile x y zmin path' or rxp2ply.py's 'tile x y' (tile corner, z and path None).
+    Tiles are names as in the file, with the --plot-code prefix if one was set.
+    """
+
+    rows = []
+    with open(fp) as fh:
+        for line in fh:
+            fields = line.split()
+            if len(fields) >= 5:
+                rows.append((fields[0], float(fields[1]), float(fields[2]), float(fields[3]), fields[4]))
+            elif len(fields) == 3:
+                rows.append((fields[0], float(fields[1]), float(fields[2]), None, None))
+    return rows
+
+
+def build(tile_index, output=None, tile_length=None, cell=None):
+    """
+    Write the spatial index of tile_index (default next to it as .npz) and return its path.
+    Bboxes and counts come from each tile's stats sidecar (computed if missing), rxp2ply.py's
+    index without paths needs tile_length to give every tile its square. cell is the grid
+    hash spacing, default the median tile width.
+    """
+
+    rows = read_tile_index(tile_index)
+    tiles = np.zeros(len(rows), dtype=TILE_DTYPE)
+    for i, (tile, x, y, z, path) in enumerate(rows):
+        tiles[i]['tile'], tiles[i]['x'], tiles[i]['y'] = tile, x, y
+        tiles[i]['z'] = np.nan if z is None else z
+        stats = ply_io.ply_stats(path) if path is not None and os.path.isfile(path) else None
+        if stats is not None and 'bbox' in stats:
+            tiles[i]['bbox'], tiles[i]['count'] = stats['bbox'], stats['count']
+        elif path is None and tile_length:
+            tiles[i]['bbox'], tiles[i]['count'] = [x, y, np.nan, x + tile_length, y + tile_length, np.nan], -1
+        else:
+            # missing or empty tile, a point at its centre so it can still be found
+            tiles[i]['bbox'] = [x, y, tiles[i]['z'], x, y, tiles[i]['z']]
+            tiles[i]['count'] = -1 if stats is None else stats['count']
+    paths = np.array([path or '' for *_, path in rows], dtype=str)
+
+    bbox = tiles['bbox']
+    if cell is None:
+        widths = np.maximum(bbox[:, 3] - bbox[:, 0], bbox[:, 4] - bbox[:, 1])
+        cell = float(np.median(widths[widths > 0])) if (widths > 0).any() else 1.0
+    x0, y0 = (bbox[:, 0].min(), bbox[:, 1].min()) if len(tiles) else (0.0, 0.0)
+    nx = int((bbox[:, 3].max() - x0) // cell) + 1 if len(tiles) else 1
+    ny = int((bbox[:, 4].max() - y0) // cell) + 1 if len(tiles) else 1
+
+    # grid hash as CSR, the rows of the tiles whose bbox overlaps each cell
+    cells, members = [], []
+    for i, b in enumerate(bbox):
+        ix = np.arange(int((b[0] - x0) // cell), int((b[3] - x0) // cell) + 1)
+        iy = np.arange(int((b[1] - y0) // cell), int((b[4] - y0) // cell) + 1)
+        cell_ids = (ix[:, None] * ny + iy[None, :]).ravel()
+        cells.append(cell_ids)
+        members.append(np.full(len(cell_ids), i))
+    cells = np.concatenate(cells) if cells else np.empty(0, dtype=np.int64)
+    members = np.concatenate(members) if members else np.empty(0, dtype=np.int64)
+    order = np.argsort(cells, kind='stable')
+    cell_start = np.searchsorted(cells[order], np.arange(nx * ny + 1)).astype(np.int32)
+
+    output = output or index_path(tile_index)
+    with open(output + '.tmp', 'wb') as fh:
+        np.savez(
+            fh,
+            tiles=tiles,
+            paths=paths,
+            grid=np.array([x0, y0, cell, nx, ny], dtype='f8'),
+            cell_start=cell_start,
+            cell_tiles=members[order].astype(np.int32),
+        )
+    os.replace(output + '.tmp', output)
+    return output
+
+
+class SpatialIndex:
+    """
+    Queries over an index written by build(), results are tile names in
+    ascending order (nearest() and neighbours() in order of distance).
+    """
+
+    def __init__(self, fp):
+        with np.load(fp) as data:
+            self.tiles = data['tiles']
+            self.paths = data['paths']
+            x0, y0, self.cell, nx, ny = data['grid']
+            self.origin = (x0, y0)
+            self.shape = (int(nx), int(ny))
+            self.cell_start = data['cell_start']
+            self.cell_tiles = data['cell_tiles']
+        self.rows = {str(t): i for i, t in enumerate(self.tiles['tile'])}
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def path(self, tile):
+        return str(self.paths[self.rows[tile]])
+
+    def _cell(self, x, y):
+        return int((x - self.origin[0]) // self.cell), int((y - self.origin[1]) // self.cell)
+
+    def _rows(self, ix0, iy0, ix1, iy1):
+        # rows of the tiles registered in cells [ix0, ix1] x [iy0, iy1], clipped to the grid
+        ix0, iy0 = max(ix0, 0), max(iy0, 0)
+        ix1, iy1 = min(ix1, self.shape[0] - 1), min(iy1, self.shape[1] - 1)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.empty(0, dtype=np.int32)
+        rows = [
+            self.cell_tiles[self.cell_start[ix * self.shape[1] + iy0] : self.cell_start[ix * self.shape[1] + iy1 + 1]]
+            for ix in range(ix0, ix1 + 1)
+        ]
+        return np.unique(np.concatenate(rows))
+
+    def _distance(self, rows, x, y):
+        # distance in plan from (x, y) to the bboxes of rows, 0 inside
+        b = self.tiles['bbox'][rows]
+        dx = np.maximum(np.maximum(b[:, 0] - x, x - b[:, 3]), 0)
+        dy = np.maximum(np.maximum(b[:, 1] - y, y - b[:, 4]), 0)
+        return np.hypot(dx, dy)
+
+    def point(self, x, y):
+        """Tiles whose bbox contains (x, y)"""
+        rows = self._rows(*self._cell(x, y), *self._cell(x, y))
+        rows = rows[self._distance(rows, x, y) == 0]
+        return np.sort(self.tiles['tile'][rows])
+
+    def bbox(self, xmin, ymin, xmax, ymax):
+        """Tiles whose bbox overlaps [xmin, ymin, xmax, ymax]"""
+        rows = self._rows(*self._cell(xmin, ymin), *self._cell(xmax, ymax))
+        b = self.tiles['bbox'][rows]
+        rows = rows[(b[:, 0] <= xmax) & (b[:, 3] >= xmin) & (b[:, 1] <= ymax) & (b[:, 4] >= ymin)]
+        return np.sort(self.tiles['tile'][rows])
+
+    def nearest(self, x, y, k=1, exclude=()):
+        """
+        The k tiles nearest (x, y) by plan distance to their bbox, ties by distance to
+        their tile_index.dat centre. Searches rings of grid cells outwards and stops once
+        no unseen tile can be nearer than the k-th found.
+        """
+
+        k = min(k, len(self) - len(exclude))
+        if k <= 0:
+            return np.empty(0, dtype=self.tiles['tile'].dtype)
+        ix, iy = self._cell(x, y)
+        skip = [self.rows[t] for t in exclude if t in self.rows]
+        r = 0
+        while True:
+            rows = np.setdiff1d(self._rows(ix - r, iy - r, ix + r, iy + r), skip)
+            distance = self._distance(rows, x, y)
+            covered = ix - r <= 0 and iy - r <= 0 and ix + r >= self.shape[0] - 1 and iy + r >= self.shape[1] - 1
+            # tiles not yet seen lie outside the (2r + 1)**2 cells, at least r cells away
+            if covered or (len(rows) >= k and np.partition(distance, k - 1)[k - 1] <= r * self.cell):
+                break
+            r += 1
+        centre = np.hypot(self.tiles['x'][rows] - x, self.tiles['y'][rows] - y)
+        return self.tiles['tile'][rows[np.lexsort((centre, distance))[:k]]]
+
+    def neighbours(self, tile, k=8):
+        """The k tiles nearest the centre of tile's bbox, tile itself excluded"""
+        b = self.tiles['bbox'][self.rows[tile]]
+        return self.nearest((b[0] + b[3]) / 2, (b[1] + b[4]) / 2, k, exclude=(tile,))
+
+
+def load(fp):
+    return SpatialIndex(fp)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('build', help='index a tile_index.dat')
+    p.add_argument('tile_index', type=str, help='tile_index.dat from tile_index.py or rxp2ply.py')
+    p.add_argument('-o', '--output', type=str, default=None, help='index file, default tile_index.npz alongside')
+    p.add_argument('--tile-length', type=float, default=None, help='tile length of an rxp2ply.py tile_index.dat')
+    p.add_argument('--cell', type=float, default=None, help='grid hash spacing, default the median tile width')
+
+    for name, description in [
+        ('point', 'tiles containing x y'),
+        ('bbox', 'tiles overlapping xmin ymin xmax ymax'),
+        ('nearest', 'k tiles nearest x y'),
+        ('neighbours', 'k tiles nearest a tile'),
+    ]:
+        p = commands.add_parser(name, help=description)
+        p.add_argument('index', type=str, help='index file written by build')
+        if name == 'point' or name == 'nearest':
+            p.add_argument('coords', type=float, nargs=2, metavar=('X', 'Y'))
+        elif name == 'bbox':
+            p.add_argument('coords', type=float, nargs=4, metavar=('XMIN', 'YMIN', 'XMAX', 'YMAX'))
+        else:
+            p.add_argument('tile', type=str)
+        if name == 'nearest' or name == 'neighbours':
+            p.add_argument('-k', type=int, default=8, help='number of tiles')
+        p.add_argument('--paths', action='store_true', help='print tile paths one per line instead of names')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        print(build(args.tile_index, args.output, args.tile_length, args.cell))
+    else:
+        index = load(args.index)
+        if args.command == 'point':
+            tiles = index.point(*args.coords)
+        elif args.command == 'bbox':
+            tiles = index.bbox(*args.coords)
+        elif args.command == 'nearest':
+            tiles = index.nearest(*args.coords, k=args.k)
+        else:
+            tiles = index.neighbours(args.tile, k=args.k)
+        if args.paths:
+            print('\n'.join(index.path(str(t)) for t in tiles))
+        else:
+            print(' '.join(str(t) for t in tiles))
@@ -5,8 +5,8 @@ import json
 import argparse
 from datetime import datetime
 
-
-import pdal
+import ply_io
+import spatial_index
 
 start = datetime.now()
 
@@ -19,23 +19,28 @@ def tile_index(ply, args):
             print(msg)
             write_to_log(msg, args.log_file)
 
-    reader = {"type":f"readers{os.path.splitext(ply)[1]}",
-              "filename":ply}
-    stats =  {"type":"filters.stats",
-              "dimensions":"X,Y,Z"}
-    JSON = json.dumps([reader, stats])
-    pipeline = pdal.Pipeline(JSON)
-    pipeline.execute()
-    JSON = pipeline.metadata
-    X = JSON['metadata']['filters.stats']['statistic'][0]['average']
-    Y = JSON['metadata']['filters.stats']['statistic'][1]['average']
-    Z = JSON['metadata']['filters.stats']['statistic'][2]['minimum']
+    # the statistics sidecar written with the tile, or one memory mapped pass 
+    # over it (which writes the sidecar for next time), PDAL for other formats
+    stats = ply_io.ply_stats(ply) if ply.endswith('.ply') else None
+    if stats is not None and all(c in stats['columns'] for c in 'xyz'):
+        X = stats['columns']['x']['mean']
+        Y = stats['columns']['y']['mean']
+        Z = stats['columns']['z']['min']
+    else:
+        import pdal
+        reader = {"type":f"readers{os.path.splitext(ply)[1]}",
+                  "filename":ply}
+        stats =  {"type":"filters.stats",
+                  "dimensions":"X,Y,Z"}
+        JSON = json.dumps([reader, stats])
+        pipeline = pdal.Pipeline(JSON)
+        pipeline.execute()
+        JSON = pipeline.metadata
+        X = JSON['metadata']['filters.stats']['statistic'][0]['average']
+        Y = JSON['metadata']['filters.stats']['statistic'][1]['average']
+        Z = JSON['metadata']['filters.stats']['statistic'][2]['minimum']
     T = os.path.split(ply)[1].split('.')[0]
     P = os.path.abspath(ply)
-    
-    with args.Lock:
-        with open(args.tile_index, 'a') as fh:
-            fh.write(f'{T} {X} {Y} {Z} {P}\n')
             
     end_time = datetime.now()
     if args.verbose:
@@ -46,6 +51,21 @@ def tile_index(ply, args):
         write_to_log(msg, args.log_file)
         write_to_log(msg, args.log_file)
 
+    return T, X, Y, Z, P
+
+def write_tile_index(rows, tile_index):
+
+    """
+    Write (tile, X, Y, Z, path) rows to tile_index in tile order, through a 
+    temporary file so readers never see a partial index.
+    """
+
+    rows = sorted(rows, key=lambda r: (int(r[0]) if r[0].isdigit() else float('inf'), r[0]))
+    with open(tile_index + '.tmp', 'w') as fh:
+        for T, X, Y, Z, P in rows:
+            fh.write(f'{T} {X} {Y} {Z} {P}\n')
+    os.replace(tile_index + '.tmp', tile_index)
+
 def calculate_execution_time(start_time, end_time):
     # Calculate the execution time
     execution_time = end_time - start_time
@@ -68,6 +88,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-i','--pc', type=str, required=True, help='input tiles')
     parser.add_argument('-t','--tile-index', default='tile_index.dat', help='tile index file')
+    parser.add_argument('--spatial-index', action='store_true',
+                        help='also write the binary spatial index (tile_index.npz)')
     parser.add_argument('--num-prcs', type=int, default=10, help='number of cores to use')
     parser.add_argument('--log-file', type=str, default='', help='log file')
     parser.add_argument('--verbose', action='store_true', help='print something')
@@ -77,10 +99,11 @@ if __name__ == '__main__':
 
     m = multiprocessing.Manager()
     args.Lock = m.Lock()
-    pool = multiprocessing.Pool(args.num_prcs)
-    pool.starmap_async(tile_index, [(ply, args) for ply in clouds])
-    pool.close()
-    pool.join()
+    with multiprocessing.Pool(args.num_prcs) as pool:
+        rows = pool.starmap(tile_index, [(ply, args) for ply in clouds])
+    write_tile_index(rows, args.tile_index)
+    if args.spatial_index:
+        spatial_index.build(args.tile_index)
 
     end = datetime.now()
     msg = f'Total tile index runtime: {calculate_execution_time(start, end)}'
@@ -0,0 +1,410 @@
+import os
+import queue
+import struct
+import threading
+import time
+
+import numpy as np
+
+import ply_io
+
+# Record layout of the temporary .xyz files written by rxp2ply.py
+RECORD_DTYPE = np.dtype(
+    [
+        ('x', 'f8'),
+        ('y', 'f8'),
+        ('z', 'f8'),
+        ('refl', 'f4'),
+        ('dev', 'f4'),
+        ('ReturnNumber', 'u1'),
+        ('NumberOfReturns', 'u1'),
+        ('sp', 'i4'),
+    ]
+)
+
+
+def record_dtype(quantise=0):
+    # RECORD_DTYPE, with x, y and z as int32 steps when tiles are quantised
+    if not quantise:
+        return RECORD_DTYPE
+    return np.dtype([(name, '<i4' if name in ('x', 'y', 'z') else RECORD_DTYPE[name]) for name in RECORD_DTYPE.names])
+
+
+# PDAL dimension name -> record field, sp is added separately
+PDAL_FIELDS = {
+    'X': 'x',
+    'Y': 'y',
+    'Z': 'z',
+    'Reflectance': 'refl',
+    'Deviation': 'dev',
+    'ReturnNumber': 'ReturnNumber',
+    'NumberOfReturns': 'NumberOfReturns',
+}
+
+
+def tile_grid(x, y, tile, bbox, length):
+    # Dense (ix, iy) -> tile number lookup covering bbox, -1 where there is no tile
+    nx = int(np.ceil((bbox[2] - bbox[0]) / length))
+    ny = int(np.ceil((bbox[3] - bbox[1]) / length))
+    grid = np.full((nx, ny), -1, dtype=np.int32)
+    ix = np.floor_divide(np.asarray(x), length).astype(np.int64) - round(bbox[0] / length)
+    iy = np.floor_divide(np.asarray(y), length).astype(np.int64) - round(bbox[1] / length)
+    grid[ix, iy] = tile
+    return grid
+
+
+def assign_tiles(x, y, grid, origin, length):
+    # Tile number for every point, -1 for points that fall outside the grid
+    ix = np.floor_divide(x, length).astype(np.int64) - round(origin[0] / length)
+    iy = np.floor_divide(y, length).astype(np.int64) - round(origin[1] / length)
+    inside = (ix >= 0) & (ix < grid.shape[0]) & (iy >= 0) & (iy < grid.shape[1])
+    ids = np.full(len(x), -1, dtype=np.int32)
+    ids[inside] = grid[ix[inside], iy[inside]]
+    return ids
+
+
+def tile_origins(grid, origin, length):
+    # Lower left corner of every tile in the grid, indexed by tile number
+    ix, iy = np.nonzero(grid >= 0)
+    origins = np.zeros((int(grid.max()) + 1, 2))
+    origins[grid[ix, iy], 0] = (ix + round(origin[0] / length)) * length
+    origins[grid[ix, iy], 1] = (iy + round(origin[1] / length)) * length
+    return origins
+
+
+def tile_quantisation(tile_number, origins, scale, z_offset=0.0):
+    # ply_io quant of a tile, x and y relative to its lower left corner
+    return {
+        'x': (scale, float(origins[tile_number, 0])),
+        'y': (scale, float(origins[tile_number, 1])),
+        'z': (scale, float(z_offset)),
+    }
+
+
+def partition(ids, n_tiles):
+    # Stable ordering of points grouped by tile plus the slice bounds of each tile
+    keep = np.flatnonzero(ids >= 0)
+    order = keep[np.argsort(ids[keep], kind='stable')]
+    counts = np.bincount(ids[keep], minlength=n_tiles)
+    bounds = np.zeros(n_tiles + 1, dtype=np.int64)
+    np.cumsum(counts, out=bounds[1:])
+    return order, counts, bounds
+
+
+def to_records(arr, sp, order=None, quant=None):
+    """
+    Copy the fields we save from a PDAL array into RECORD_DTYPE, gathering by order if given.
+    quant maps x, y and z to (scale, offset) where offset may be an array with one value per
+    gathered point, those fields are then stored as int32 steps (see ply_io.encode).
+    """
+    n = len(arr) if order is None else len(order)
+    records = np.empty(n, dtype=record_dtype(quant is not None))
+    for src, dst in PDAL_FIELDS.items():
+        values = arr[src] if order is None else arr[src][order]
+        records[dst] = ply_io.encode(values, *quant[dst]) if quant is not None and dst in quant else values
+    records['sp'] = sp
+    return records
+
+
+def split_tiles(arr, sp, grid, origin, length, timer=None, quantise=0, z_offset=0.0):
+    """
+    Bucket a PDAL structured array into tiles in a single pass.
+
+    Yields (tile number, records) where records is a contiguous RECORD_DTYPE slice
+    holding every point of arr that falls in that tile. An optional metrics.StageTimer
+    collects the time spent assigning, partitioning and gathering. With quantise the
+    coordinates are stored as int32 steps of that size from the tile's lower left
+    corner (and z_offset), as described by tile_quantisation.
+    """
+    if len(arr) == 0:
+        return
+    start = time.perf_counter()
+    ids = assign_tiles(arr['X'], arr['Y'], grid, origin, length)
+    assigned = time.perf_counter()
+    order, counts, bounds = partition(ids, int(grid.max()) + 1)
+    partitioned = time.perf_counter()
+    quant = None
+    if quantise:
+        # per point offsets, the sorted points run through the tiles in tile number order
+        origins = np.repeat(tile_origins(grid, origin, length), counts, axis=0)
+        quant = {'x': (quantise, origins[:, 0]), 'y': (quantise, origins[:, 1]), 'z': (quantise, z_offset)}
+    records = to_records(arr, sp, order, quant)
+    if timer is not None:
+        timer.add('assign', assigned - start)
+        timer.add('partition', partitioned - assigned)
+        timer.add('gather', time.perf_counter() - partitioned)
+    for tile_number in np.flatnonzero(counts):
+        yield int(tile_number), records[bounds[tile_number] : bounds[tile_number + 1]]
+
+
+def append_file(fh, path, nbytes):
+    # Append the first nbytes of path to the open binary file fh without going through Python buffers
+    fh.flush()
+    with open(path, 'rb') as src:
+        try:
+            offset = 0
+            while offset < nbytes:
+                sent = os.sendfile(fh.fileno(), src.fileno(), offset, nbytes - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            fh.seek(0, os.SEEK_END)
+        except (AttributeError, OSError):
+            src.seek(offset)
+            fh.seek(0, os.SEEK_END)
+            remaining = nbytes - offset
+            while remaining > 0:
+                block = src.read(min(remaining, 2**24))
+                if not block:
+                    break
+                fh.write(block)
+                remaining -= len(block)
+
+
+# Compressed shards (.xyzc) start with SHARD_MAGIC and the codec name, followed by frames of
+# (compressed bytes, raw bytes) and the compressed block, one frame per tile per flush. Records
+# are byte shuffled before compression (see shuffle), which compresses coordinates far better
+SHARD_MAGIC = b'XYZC'
+FRAME = struct.Struct('<QQ')
+
+
+def get_codec(name):
+    # (compress, decompress(data, raw_nbytes)) of a shard codec, zstd and lz4 need their Python packages
+    if name == 'zlib':
+        import zlib
+
+        return (lambda data: zlib.compress(data, 1)), (lambda data, n: zlib.decompress(data, bufsize=n))
+    try:
+        if name == 'zstd':
+            import zstandard
+
+            return (
+                zstandard.ZstdCompressor(level=1).compress,
+                lambda data, n: zstandard.ZstdDecompressor().decompress(data, max_output_size=n),
+            )
+        if name == 'lz4':
+            import lz4.frame
+
+            return lz4.frame.compress, (lambda data, n: lz4.frame.decompress(data))
+    except ImportError as e:
+        raise Exception(f'shard codec {name} needs the {e.name} package, install it or use zlib') from e
+    raise Exception(f'unknown shard codec {name}')
+
+
+def shuffle(records):
+    # Bytes of records regrouped field by field and byte by byte, the first byte of every x, then the second ...
+    return b''.join(
+        np.ascontiguousarray(records[name]).view('u1').reshape(-1, records.dtype[name].itemsize).T.tobytes()
+        for name in records.dtype.names
+    )
+
+
+def unshuffle(data, dtype):
+    # Records of dtype from the bytes of shuffle
+    n = len(data) // dtype.itemsize
+    planes = np.frombuffer(data, dtype='u1')
+    records = np.empty(n, dtype=dtype)
+    offset = 0
+    for name in dtype.names:
+        size = dtype[name].itemsize
+        field = planes[offset : offset + n * size].reshape(size, n).T
+        records[name] = np.ascontiguousarray(field).view(dtype[name]).ravel()
+        offset += n * size
+    return records
+
+
+def shard_extension(codec):
+    return '.xyz' if codec in (None, 'none') else '.xyzc'
+
+
+def read_frames(path):
+    # Codec name and the (offset, compressed bytes, raw bytes) of every frame of a compressed shard
+    frames = []
+    with open(path, 'rb') as fh:
+        head = fh.read(8)
+        if head[:4] != SHARD_MAGIC:
+            raise Exception(f'{path} is not a compressed shard')
+        codec = head[4:].decode('ascii').strip()
+        while True:
+            frame = fh.read(FRAME.size)
+            if len(frame) < FRAME.size:
+                break
+            packed, raw = FRAME.unpack(frame)
+            frames.append((fh.tell(), packed, raw))
+            fh.seek(packed, os.SEEK_CUR)
+    return codec, frames
+
+
+def shard_nbytes(path, itemsize):
+    # Bytes of whole records in a raw or compressed shard
+    if path.endswith('.xyzc'):
+        return sum(raw for _, _, raw in read_frames(path)[1]) // itemsize * itemsize
+    return os.path.getsize(path) // itemsize * itemsize
+
+
+def iter_shard(path, dtype):
+    # Records of a compressed shard, one frame at a time
+    codec, frames = read_frames(path)
+    decompress = get_codec(codec)[1]
+    with open(path, 'rb') as fh:
+        for offset, packed, raw in frames:
+            fh.seek(offset)
+            yield unshuffle(decompress(fh.read(packed), raw), dtype)
+
+
+def shard_stats(path, dtype, nbytes, quant=None):
+    # ply_io.PlyStats of a shard, from the sidecar written by ShardWriter or else read back
+    stats = ply_io.ply_stats(path, compute=False)
+    if stats is not None and stats['count'] * dtype.itemsize == nbytes:
+        return ply_io.PlyStats.from_dict(stats)
+    stats = ply_io.PlyStats()
+    records = read_shard(path, dtype, nbytes)
+    stats.update(ply_io.select(records, dtype.names, quant=quant) if quant else records)
+    return stats
+
+
+def append_shard(fh, path, nbytes, dtype):
+    # Append the first nbytes of records of a raw or compressed shard to fh
+    if not path.endswith('.xyzc'):
+        append_file(fh, path, nbytes)
+        return
+    fh.seek(0, os.SEEK_END)
+    for records in iter_shard(path, dtype):
+        records = records[: nbytes // dtype.itemsize]
+        records.tofile(fh)
+        nbytes -= records.nbytes
+        if nbytes <= 0:
+            break
+
+
+def read_shard(path, dtype, nbytes):
+    # Records of a raw or compressed shard as an array
+    if not path.endswith('.xyzc'):
+        return np.fromfile(path, dtype=dtype, count=nbytes // dtype.itemsize)
+    blocks = list(iter_shard(path, dtype))
+    return np.concatenate(blocks)[: nbytes // dtype.itemsize] if blocks else np.empty(0, dtype=dtype)
+
+
+class ShardWriter:
+    """
+    Appends tile records to per-shard .xyz files from a background thread.
+
+    Each worker owns its shard files ({prefix}{tile}.{shard}.xyz) so no locking
+    is needed. Records are buffered per tile and handed to the writer thread
+    once flush_bytes have accumulated, so file I/O overlaps further tiling.
+    Shards are written as .xyz.part files and only renamed to .xyz by commit().
+    Used as a context manager the shards are committed when the block exits
+    cleanly and removed otherwise. With a codec (zlib, zstd or lz4) every flush
+    is compressed by the writer thread into a frame of a .xyzc shard instead.
+    The writer thread also keeps a ply_io.PlyStats per tile, saved as the shard's
+    stats sidecar on commit, quant(tile_number) gives the ply_io quant the records
+    of a tile are encoded with so the statistics are of the decoded coordinates.
+    """
+
+    def __init__(self, odir, prefix, shard, n, flush_bytes=64 * 2**20, codec=None, quant=None):
+        self.odir = odir
+        self.prefix = prefix
+        self.shard = shard
+        self.n = n
+        self.flush_bytes = flush_bytes
+        self.codec = None if codec == 'none' else codec
+        self.compress = get_codec(self.codec)[0] if self.codec else None
+        self.buffers = {}
+        self.buffered = 0
+        self.tiles = set()
+        self.points = {}
+        self.bytes = {}
+        self.wait_seconds = 0.0
+        self.write_seconds = 0.0
+        self.compressed = {}
+        self.quant = quant
+        self.stats = {}
+        self.error = None
+        self.queue = queue.Queue(maxsize=2)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+    def path(self, tile_number):
+        name = f'{self.prefix}{str(tile_number).zfill(self.n)}.{self.shard}{shard_extension(self.codec)}'
+        return os.path.join(self.odir, name)
+
+    def write(self, tile_number, records):
+        if len(records) == 0:
+            return
+        self.buffers.setdefault(tile_number, []).append(records)
+        self.buffered += records.nbytes
+        self.tiles.add(tile_number)
+        self.points[tile_number] = self.points.get(tile_number, 0) + len(records)
+        self.bytes[tile_number] = self.bytes.get(tile_number, 0) + records.nbytes
+        if self.buffered >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if self.buffers:
+            start = time.perf_counter()
+            self.queue.put(self.buffers)
+            self.wait_seconds += time.perf_counter() - start
+            self.buffers = {}
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        start = time.perf_counter()
+        self.queue.put(None)
+        self.thread.join()
+        self.wait_seconds += time.perf_counter() - start
+        if self.error is not None:
+            raise self.error
+
+    def commit(self):
+        self.close()
+        for tile_number in self.tiles:
+            os.replace(self.path(tile_number) + '.part', self.path(tile_number))
+            ply_io.write_stats(self.path(tile_number), self.stats[tile_number])
+
+    def abort(self):
+        self.buffers = {}
+        self.queue.put(None)
+        self.thread.join()
+        for tile_number in self.tiles:
+            if os.path.isfile(self.path(tile_number) + '.part'):
+                os.unlink(self.path(tile_number) + '.part')
+
+    def _run(self):
+        while True:
+            buffers = self.queue.get()
+            if buffers is None:
+                break
+            if self.error is not None:
+                continue
+            start = time.perf_counter()
+            try:
+                for tile_number, chunks in buffers.items():
+                    stats = self.stats.setdefault(tile_number, ply_io.PlyStats())
+                    quant = self.quant(tile_number) if self.quant else {}
+                    for chunk in chunks:
+                        stats.update(ply_io.select(chunk, chunk.dtype.names, quant=quant) if quant else chunk)
+                    with open(self.path(tile_number) + '.part', 'ab') as fh:
+                        if self.compress is None:
+                            for chunk in chunks:
+                                chunk.tofile(fh)
+                            continue
+                        if fh.tell() == 0:
+                            fh.write(SHARD_MAGIC + self.codec.ljust(4).encode('ascii'))
+                        raw = shuffle(np.concatenate(chunks))
+                        packed = self.compress(raw)
+                        fh.write(FRAME.pack(len(packed), len(raw)))
+                        fh.write(packed)
+                        self.compressed[tile_number] = self.compressed.get(tile_number, 0) + FRAME.size + len(packed)
+            except Exception as e:
+                self.error = e
+            self.write_seconds += time.perf_counter() - start
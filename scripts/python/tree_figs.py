@@ -29,6 +29,7 @@ if __name__ == '__main__':
     parser.add_argument('--include-name', action='store_true', help='remove scale bar')
     parser.add_argument('--no-dbh-class', action='store_true', help='if trees are in dbh class subdirectories')
     parser.add_argument('--test', action='store_true', help='test')
+    parser.add_argument('--workers', default=8, type=int, help='number of files read concurrently')
     args = parser.parse_args()
 
     # list files
@@ -48,20 +49,36 @@ if __name__ == '__main__':
         TT = {os.path.split(t)[1][:-11]:t[:-4] for t in T}
         df.loc[:, 'PATH'] = df.tree.map(TT)
 
-    # read in point clouds
-    info = pd.DataFrame(columns=['TreeHeight', 'xptp', 'yptp', 'cnt'])
-    clda = pd.DataFrame()
-    
-    for i, c in tqdm(enumerate(T), total=len(T)):
-        cld = ply_io.read_ply(c).loc[::args.downsample]
-        cld = cld[[c for c in cld.columns if c in ['x', 'y', 'z', 'label', 'wood']]]
-        if 'label' in cld.columns and args.leaf_off: cld = cld.loc[cld.label == 3]
-#        cld = cld[['x', 'y', 'z', 'wood' if 'wood' in cld.columns else None, 'label' if 'label' in cld.columns else None]]
-        info.loc[c[:-4], ['xptp', 'yptp', 'TreeHeight']] = np.ptp(cld[['x', 'y', 'z']].values, axis=0)
-        info.loc[c[:-4], 'cnt'] = len(cld)
-        cld.loc[:, 'name'] = os.path.split(c)[1][:-4]
-        clda = pd.concat([clda, cld])
-        if args.test and i > 10: break
+    # read in point clouds, concurrently
+    if args.test:
+        T = T[:12]
+    if len(T) == 0:
+        raise Exception('no points clouds were read in, check file paths')
+    # trees are read in groups with the same columns (headers are cheap to read), so each tree
+    # is still filtered and coloured by its own label / wood columns, missing ones are NaN
+    groups = {}
+    for t in T:
+        names = ply_io.read_ply_header(t)[2].names
+        groups.setdefault(tuple(f for f in ['x', 'y', 'z', 'label', 'wood'] if f in names), []).append(t)
+    T = [t for group in groups.values() for t in group]
+    labelled = {os.path.split(t)[1][:-4] for fields, group in groups.items() if 'label' in fields for t in group}
+    clda, offsets = [], [0]
+    for fields, group in groups.items():
+        arr, group_offsets = ply_io.read_many(group, columns=list(fields), workers=args.workers, concat=True,
+                                              as_array=True, step=args.downsample,
+                                              where={'label': 3} if 'label' in fields and args.leaf_off else None)
+        clda.append(pd.DataFrame({c: arr[c] for c in arr.dtype.names}))
+        offsets += list(offsets[-1] + group_offsets[1:])
+    clda = pd.concat(clda, ignore_index=True)
+    offsets = np.array(offsets)
+    clda.loc[:, 'name'] = np.repeat([os.path.split(c)[1][:-4] for c in T], np.diff(offsets))
+
+    info = pd.DataFrame(index=[c[:-4] for c in T], columns=['TreeHeight', 'xptp', 'yptp', 'cnt'])
+    XYZ = clda[['x', 'y', 'z']].values
+    for i, c in enumerate(T):
+        xyz = XYZ[offsets[i]:offsets[i + 1]]
+        info.loc[c[:-4], ['xptp', 'yptp', 'TreeHeight']] = np.ptp(xyz, axis=0) if len(xyz) else np.nan
+        info.loc[c[:-4], 'cnt'] = len(xyz)
 
     info.loc[:, 'name'] = [os.path.split(idx)[1] for idx in info.index]
     info = info.reset_index().rename(columns={'index':'PATH'})
@@ -130,7 +147,7 @@ if __name__ == '__main__':
             cld.x = cld.x - cld.x.mean() #+ halfx 
             cld.z = cld.z - cld.z.min()
    
-            if 'label' not in cld.columns:
+            if tree.name not in labelled:
                 ax.scatter(cld.x, cld.z, s=.01, marker='.', color=C) 
             elif args.leaf_off:
                 ax.scatter(cld.x.loc[cld.label == 3], cld.z.loc[cld.label == 3], s=.01, marker='.', color=C)
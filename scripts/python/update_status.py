@@ -1,17 +1,25 @@
 import argparse
+import fcntl
 import json
 import os
 import os.path
 import csv
+from contextlib import contextmanager
 from dataclasses import asdict, dataclass
 from datetime import datetime
 
 # Updates the status of a project in status.json
+#
+# status.json is a snapshot, updates are appended as one JSON event per line to
+# status.json.journal under an flock on status.json.lock and replayed over the
+# snapshot by readers. The journal is folded into the snapshot once it grows past
+# COMPACT_BYTES, or with --compact.
 
 DEFAULT_STATUS_FILE = f"{os.environ['LOG_ROOT']}/status.json"
 RUNNING_STATUS = "running"
 COMPLETED_STATUS = "done"
 DEFAULT_LOG_FILE = f"{os.environ['LOG_ROOT']}/commands.log"
+COMPACT_BYTES = 1024 * 1024
 
 
 @dataclass
@@ -27,22 +35,110 @@ class Step:
             self.duration = calculate_duration(self.date_started, self.date_finished)
 
 
-def load_status(status_file):
+def journal_path(status_file):
+    return status_file + ".journal"
+
+
+@contextmanager
+def locked(status_file, exclusive=True):
+    # Shared for readers, exclusive for appends and compaction
+    with open(status_file + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def read_snapshot(status_file):
     try:
         with open(status_file) as f:
             return json.load(f)
     except FileNotFoundError:
-        write_to_log(f"Status file {status_file} not found.")
+        if not os.path.isfile(journal_path(status_file)):
+            write_to_log(f"Status file {status_file} not found.")
     except json.JSONDecodeError:
         write_to_log(f"Error decoding JSON from {status_file}.")
     return {}
 
 
-def save_status(data, status_file):
+def apply_event(data, event):
+    project = event["project"]
+    if event["op"] == "clear":
+        if project in data:
+            data[project] = []
+        return
+
+    step = Step(**event["step"])
+    for existing_step in data.setdefault(project, []):
+        if existing_step["name"] == step.name:
+            # Only overwrite the start_date if the status is running
+            if step.status == RUNNING_STATUS:
+                existing_step["date_started"] = step.date_started
+            elif step.status == COMPLETED_STATUS:
+                step.date_started = existing_step[
+                    "date_started"
+                ]  # Keep the original start date
+                step.calculate_duration()
+            existing_step.update(asdict(step))
+            break
+    else:
+        step.calculate_duration()
+        data[project].append(asdict(step))
+
+
+def _load_status(status_file):
+    data = read_snapshot(status_file)
+    try:
+        with open(journal_path(status_file)) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn line of a killed writer
+                apply_event(data, event)
+    except FileNotFoundError:
+        pass
+    for project in data:
+        data[project].sort(key=lambda step: step["name"])
+    return data
+
+
+def load_status(status_file):
+    # The snapshot with the journal replayed over it, a consistent view under the shared lock
+    with locked(status_file, exclusive=False):
+        return _load_status(status_file)
+
+
+def _save_status(data, status_file):
+    # Caller holds the exclusive lock. Events are idempotent over a snapshot that
+    # already includes them, so a crash before the journal is emptied is harmless.
     for project in data:
         data[project].sort(key=lambda step: step["name"])
-    with open(status_file, "w") as f:
+    with open(status_file + ".tmp", "w") as f:
         json.dump(data, f, indent=4)
+    os.replace(status_file + ".tmp", status_file)
+    open(journal_path(status_file), "w").close()
+
+
+def save_status(data, status_file):
+    # Replace the whole status, e.g. after a rebuild from the logs
+    with locked(status_file):
+        _save_status(data, status_file)
+
+
+def compact_status(status_file=DEFAULT_STATUS_FILE):
+    with locked(status_file):
+        _save_status(_load_status(status_file), status_file)
+
+
+def append_event(event, status_file):
+    # O(1) update, one write of a whole line in append mode
+    with locked(status_file):
+        with open(journal_path(status_file), "a") as f:
+            f.write(json.dumps(event) + "\n")
+        if os.path.getsize(journal_path(status_file)) > COMPACT_BYTES:
+            _save_status(_load_status(status_file), status_file)
 
 
 def calculate_duration(start_date, end_date):
@@ -80,40 +176,14 @@ def calculate_duration(start_date, end_date):
 
 
 def clear_project_steps(project, status_file=DEFAULT_STATUS_FILE):
-    # Load the current status
-    data = load_status(status_file)
-
-    # Check if the project exists in the status
-    if project in data:
-        # Clear the steps for the project
-        data[project] = []
-
-        # Save the updated status
-        save_status(data, status_file)
+    append_event({"op": "clear", "project": project}, status_file)
 
 
 def update_status(project, step, status_file=DEFAULT_STATUS_FILE):
-    data = load_status(status_file)
-    data.setdefault(project, [])
-
-    for existing_step in data[project]:
-        if existing_step["name"] == step.name:
-            # Only overwrite the start_date if the status is running
-
-            if step.status == RUNNING_STATUS:
-                existing_step["date_started"] = step.date_started
-            elif step.status == COMPLETED_STATUS:
-                step.date_started = existing_step[
-                    "date_started"
-                ]  # Keep the original start date
-                step.calculate_duration()
-            existing_step.update(asdict(step))
-            break
-    else:
-        step.calculate_duration()
-        data[project].append(asdict(step))
-
-    save_status(data, status_file)
+    # Merged with the existing step (see apply_event) when the journal is replayed
+    append_event(
+        {"op": "update", "project": project, "step": asdict(step)}, status_file
+    )
 
 
 def get_project_status(project, status_file=DEFAULT_STATUS_FILE):
@@ -139,7 +209,89 @@ def get_date_from_line(line, prefix):
     raise ValueError(f"No valid date format found for date string: {date_str}")
 
 
-def update_status_from_logs(project, log_dir):
+def log_step(log_file):
+    # Step name and status from a log file name, STEP_DONE_x.log is the done step of STEP_x.log
+    if "DONE" not in log_file:
+        return log_file.replace("_", " ").replace(".log", ""), RUNNING_STATUS
+    step_name = log_file.replace("_DONE_", " ").replace(".log", "").replace("_", " ")
+    return step_name, COMPLETED_STATUS
+
+
+def parse_log(path, cached=None):
+    """
+    Step of the log file at path, reusing the cached entry of a previous rebuild
+    when size and mtime are unchanged and parsing only the lines appended since
+    when it has grown. Returns the step as a dict and the new cache entry.
+    """
+
+    stat = os.stat(path)
+    cached = cached or {}
+    if cached.get("size") == stat.st_size and cached.get("mtime") == stat.st_mtime:
+        return cached["step"], cached
+    if cached.get("size", 0) > stat.st_size or "offset" not in cached:
+        # new or truncated log, parse from the start
+        cached = {"offset": 0, "date_started": None, "date_finished": None}
+
+    entry = dict(cached)
+    with open(path, "rb") as f:
+        f.seek(entry["offset"])
+        data = f.read()
+    # whole lines only, a partly written last line is parsed next time
+    data = data[: data.rfind(b"\n") + 1]
+    entry["offset"] += len(data)
+    for line in data.decode(errors="replace").splitlines():
+        # Look for the line that starts with 'Date Run:'
+        if line.startswith("Date Run:"):
+            entry["date_started"] = get_date_from_line(line, "Date Run:").strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+        # Look for the line that starts with 'End time:'
+        elif line.startswith("End time:"):
+            entry["date_finished"] = get_date_from_line(line, "End time:").strftime(
+                "%Y-%m-%d %H:%M:%S"
+            )
+
+    step_name, step_status = log_step(os.path.basename(path))
+    date_finished = entry["date_finished"] or datetime.fromtimestamp(
+        stat.st_mtime
+    ).strftime("%Y-%m-%d %H:%M:%S")
+    step = Step(
+        name=step_name,
+        status=step_status,
+        date_started=entry["date_started"],
+        date_finished=date_finished,
+    )
+    entry.update(size=stat.st_size, mtime=stat.st_mtime, step=asdict(step))
+    return entry["step"], entry
+
+
+def rebuild_project(project_dir, cache):
+    # Steps of one project from its log files, running logs applied before done ones
+    log_files = sorted(
+        (file for file in os.listdir(project_dir) if file.endswith(".log")),
+        key=lambda file: ("DONE" in file, file),
+    )
+    project = os.path.basename(project_dir)
+    data, entries = {project: []}, {}
+    for log_file in log_files:
+        path = os.path.join(project_dir, log_file)
+        step, entries[path] = parse_log(path, cache.get(path))
+        if step["name"]:
+            apply_event(data, {"op": "update", "project": project, "step": step})
+    return data[project], entries
+
+
+def update_status_from_logs(
+    project, log_dir, status_file=DEFAULT_STATUS_FILE, workers=8, full=False
+):
+    """
+    Rebuild the steps of project (all projects in log_dir if empty) from their
+    log files in one pass, projects in parallel, and commit them in one write.
+    Logs unchanged since the last rebuild are not read again, see parse_log.
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
     if project:
         # If a project name is given, only iterate over the log files in that project's directory
         projects = [project]
@@ -151,63 +303,32 @@ def update_status_from_logs(project, log_dir):
             if os.path.isdir(os.path.join(log_dir, dir))
         ]
 
-    for project in projects:
-        clear_project_steps(project)
-        project_dir = os.path.join(log_dir, project)
-        # Check if there are any log files in the project directory
-        log_files = [file for file in os.listdir(project_dir) if file.endswith(".log")]
-        if not log_files:
-            # If there are no log files, skip to the next project directory
-            continue
-        # Iterate over all log files in the project directory
-        for log_file in log_files:
-            if log_file.endswith(".log"):
-                # Check if the log file name contains 'DONE'
-                step_status = COMPLETED_STATUS if "DONE" in log_file else RUNNING_STATUS
-                if "DONE" not in log_file:
-                    step_name = log_file.replace("_", " ").replace(".log", "")
-                else:
-                    step_name = (
-                        log_file.replace("_DONE_", " ")
-                        .replace(".log", "")
-                        .replace("_", " ")
-                    )
-
-                date_started = None
-                date_finished = None
-                # Open the log file and read its contents
-                with open(os.path.join(project_dir, log_file)) as f:
-                    for line in f:
-                        # Look for the line that starts with 'Date Run:'
-                        if line.startswith("Date Run:"):
-                            date_started = get_date_from_line(line, "Date Run:")
-                        # Look for the line that starts with 'End time:'
-                        elif line.startswith("End time:"):
-                            date_finished = get_date_from_line(line, "End time:")
-                if date_finished is None:
-                    date_finished = datetime.fromtimestamp(
-                        os.path.getmtime(os.path.join(project_dir, log_file))
-                    )
-
-                # Format date_started and date_finished in the '%Y-%m-%d %H:%M:%S' format if they are not None
-                date_started = (
-                    date_started.strftime("%Y-%m-%d %H:%M:%S") if date_started else None
-                )
-                date_finished = (
-                    date_finished.strftime("%Y-%m-%d %H:%M:%S")
-                    if date_finished
-                    else None
-                )
-
-            step = Step(
-                name=step_name,
-                status=step_status,
-                date_started=date_started,
-                date_finished=date_finished,
+    cache_file = status_file + ".logcache"
+    cache = {}
+    if not full and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    with ThreadPoolExecutor(workers) as pool:
+        results = list(
+            pool.map(
+                lambda project: rebuild_project(os.path.join(log_dir, project), cache),
+                projects,
             )
-            # Only update the step there is a project and a step name.
-            if project and step.name:
-                update_status(project, step, args.status_file)
+        )
+
+    with locked(status_file):
+        data = _load_status(status_file)
+        for project, (steps, entries) in zip(projects, results):
+            data[project] = steps
+            # drop entries of logs that have gone, keep those of other projects
+            project_dir = os.path.join(log_dir, project) + os.sep
+            cache = {k: v for k, v in cache.items() if not k.startswith(project_dir)}
+            cache.update(entries)
+        _save_status(data, status_file)
+        with open(cache_file + ".tmp", "w") as f:
+            json.dump(cache, f)
+        os.replace(cache_file + ".tmp", cache_file)
 
 
 def write_to_log(msg='Update: ', data={}, log_file=DEFAULT_LOG_FILE):
@@ -261,7 +382,22 @@ if __name__ == "__main__":
         "--update-from-logs", action="store_true", help="update status from log files"
     )
     parser.add_argument("--command", nargs='+', default='', help='command that was run')
+    parser.add_argument(
+        "--compact", action="store_true", help="fold the journal into the status file"
+    )
+    parser.add_argument(
+        "--full-rebuild",
+        action="store_true",
+        help="with --update-from-logs, parse every log file again",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=8, help="projects rebuilt in parallel"
+    )
     args = parser.parse_args()
+
+    if args.compact:
+        compact_status(args.status_file)
+        raise SystemExit
     
     # Set the dates if the arguments are not given
     # Set date_started to the current date time if the status is running and date_started is None
@@ -281,7 +417,11 @@ if __name__ == "__main__":
 
     if args.update_from_logs:
         update_status_from_logs(
-            args.project_name, f"{os.environ['LOG_ROOT']}/{args.project_name}"
+            args.project_name,
+            os.environ["LOG_ROOT"],
+            args.status_file,
+            args.workers,
+            args.full_rebuild,
         )
     else:
         step = Step(